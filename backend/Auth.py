@@ -0,0 +1,172 @@
+import time
+import uuid
+import base64
+import secrets
+import threading
+import functools
+import jwt
+from bson import ObjectId
+from flask import request, jsonify, g
+from Cache import Cache
+
+class Auth:
+
+    """
+    * Issues and verifies signed session tokens (HS256 JWT)
+    * Access tokens are short lived, refresh tokens trade for a new pair
+    * Revoked token ids are kept in memory until the token would have expired anyway
+    * require_user is the shared decorator for every route that takes <user_id>
+    * Device tokens are long lived and only accepted by require_device (board controller routes)
+    *   Only the latest one per user is valid, issuing a new one or revoke_device_token retires it
+    * Bare user ids (no token) are deprecated and off unless AUTH_ALLOW_LEGACY_USER_ID=true
+    """
+
+    algorithm = "HS256"
+
+    def __init__(self, logging, database, secret=None, access_ttl=900, refresh_ttl=1209600, device_ttl=31536000, allow_legacy_user_id=False) -> None:
+        self.logging = logging
+        self.database = database
+        self.access_ttl = access_ttl
+        self.refresh_ttl = refresh_ttl
+        self.device_ttl = device_ttl
+        self.allow_legacy_user_id = allow_legacy_user_id
+
+        if allow_legacy_user_id:
+            self.logging.log_debug("Class: Auth | AUTH_ALLOW_LEGACY_USER_ID is enabled: bare user ids are accepted without a token. Deprecated, move devices to device tokens.")
+
+        # user id -> current device token id ("" when none), same bounds as Database.user_cache
+        # so device requests skip the users lookup, invalidated when this process issues or revokes one
+        self.device_tokens = Cache(max_size=database.config.user_cache_size, ttl=database.config.user_cache_ttl)
+
+        if not secret:
+            # Tokens then only survive as long as this process
+            self.logging.log_debug("Class: Auth | JWT_SECRET is not set, using a random per-process secret.")
+            secret = secrets.token_urlsafe(32)
+        self.secret = secret
+
+        self._revoked = {}
+        self._lock = threading.Lock()
+
+    def issue_token(self, user_id, token_type, ttl, jti=None):
+        now = int(time.time())
+        claims = {
+            "sub": str(user_id),
+            "type": token_type,
+            "jti": jti or uuid.uuid4().hex,
+            "iat": now,
+            "exp": now + ttl
+        }
+        return jwt.encode(claims, self.secret, algorithm=self.algorithm)
+
+    def issue_tokens(self, user_id):
+        return {
+            "accessToken": self.issue_token(user_id, "access", self.access_ttl),
+            "refreshToken": self.issue_token(user_id, "refresh", self.refresh_ttl),
+            "expiresIn": self.access_ttl
+        }
+
+    def issue_device_token(self, user_id):
+        # The token id is stored on the user, so the token can be retired across restarts and workers
+        jti = uuid.uuid4().hex
+        self.database.database_connection("users").update_one({ "_id": ObjectId(user_id) }, { "$set": { "device_token_id": jti } })
+        self.device_tokens.invalidate(str(user_id))
+        return {
+            "deviceToken": self.issue_token(user_id, "device", self.device_ttl, jti=jti),
+            "expiresIn": self.device_ttl
+        }
+
+    def revoke_device_token(self, user_id):
+        self.database.database_connection("users").update_one({ "_id": ObjectId(user_id) }, { "$unset": { "device_token_id": "" } })
+        self.device_tokens.invalidate(str(user_id))
+
+    def current_device_token(self, user_id):
+        # Other workers see a new or revoked token once their entry expires (user_cache_ttl)
+        jti = self.device_tokens.get(user_id)
+        if jti is None:
+            user = self.database.database_connection("users").find_one({ "_id": ObjectId(user_id) }, { "device_token_id": 1 })
+            jti = (user or {}).get("device_token_id") or ""
+            self.device_tokens.set(user_id, jti)
+        return jti
+
+    def verify(self, token, *token_types):
+        # Raises jwt.InvalidTokenError (or a subclass) when the token is not usable
+        claims = jwt.decode(token, self.secret, algorithms=[self.algorithm], options={ "require": ["sub", "jti", "exp"] })
+        if claims.get("type") not in token_types:
+            raise jwt.InvalidTokenError("Wrong token type.")
+        if claims["jti"] in self._revoked:
+            raise jwt.InvalidTokenError("Token has been revoked.")
+        if claims["type"] == "device":
+            if self.current_device_token(claims["sub"]) != claims["jti"]:
+                raise jwt.InvalidTokenError("Device token has been replaced or revoked.")
+        return claims
+
+    def revoke(self, claims):
+        now = time.time()
+        with self._lock:
+            self._revoked[claims["jti"]] = claims["exp"]
+            # Forget revocations of tokens that have expired by themselves
+            expired = [jti for jti, expires_at in self._revoked.items() if expires_at <= now]
+            for jti in expired:
+                del self._revoked[jti]
+
+    def bearer_token(self):
+        header = request.headers.get("Authorization", "")
+        if header.startswith("Bearer "):
+            return header[len("Bearer "):].strip()
+        return None
+
+    def require_user(self, view):
+        # Sets g.user_id (decoded string), g.object_user_id and g.token_claims (None without a token) for the wrapped route
+        return self.authorize(view, ("access",))
+
+    def require_device(self, view):
+        # require_user that also accepts the user's device token
+        return self.authorize(view, ("access", "device"))
+
+    def authorize(self, view, token_types):
+        @functools.wraps(view)
+        def wrapper(user_id, *args, **kwargs):
+            try:
+                decode_user_id = base64.urlsafe_b64decode(user_id).decode()
+                object_user_id = ObjectId(decode_user_id)
+            except Exception:
+                return jsonify({
+                    "errorMsg": "Invalid ID.",
+                    "statusCode": 404
+                }), 404
+
+            claims = None
+            token = self.bearer_token()
+            if token:
+                try:
+                    claims = self.verify(token, *token_types)
+                except jwt.InvalidTokenError as ex:
+                    return jsonify({
+                        "errorMsg": f"Invalid token. {ex}",
+                        "statusCode": 401
+                    }), 401
+                if claims["sub"] != decode_user_id:
+                    return jsonify({
+                        "errorMsg": "Token does not belong to this user.",
+                        "statusCode": 403
+                    }), 403
+
+            elif not self.allow_legacy_user_id:
+                return jsonify({
+                    "errorMsg": "Missing bearer token.",
+                    "statusCode": 401
+                }), 401
+
+            # Legacy clients without a token are checked against the users collection
+            elif not self.database.user_exists(object_user_id):
+                return jsonify({
+                    "errorMsg": "Invalid ID.",
+                    "statusCode": 404
+                })
+
+            g.user_id = decode_user_id
+            g.object_user_id = object_user_id
+            g.token_claims = claims
+            return view(user_id, *args, **kwargs)
+
+        return wrapper
\ No newline at end of file
@@ -0,0 +1,332 @@
+import os
+import signal
+import threading
+import urllib.parse
+import dataclasses
+from dataclasses import dataclass
+from types import MappingProxyType
+import yaml
+import dotenv
+
+class ConfigError(ValueError):
+
+    """
+    * Raised by Config.load with every invalid setting listed, so all of them can be fixed at once
+    """
+
+    def __init__(self, problems) -> None:
+        super().__init__("Invalid configuration: " + "; ".join(problems))
+        self.problems = problems
+
+@dataclass(frozen=True)
+class DatabaseConfig:
+    connection: str
+    host: str
+    port: int
+    name: str
+    username: str
+    password: str
+    timeout_ms: int
+    auth_source: str
+    app_name: str
+    max_pool_size: int
+    min_pool_size: int
+    max_idle_time_ms: int
+    wait_queue_timeout_ms: int
+    user_cache_size: int
+    user_cache_ttl: float
+
+    @property
+    def uri(self):
+        return f"{self.connection}://{self.username}:{urllib.parse.quote(self.password)}@{self.host}:{self.port}/{self.name}?directConnection=true&serverSelectionTimeoutMS={self.timeout_ms}&authSource={self.auth_source}&appName={self.app_name}"
+
+@dataclass(frozen=True)
+class LogConfig:
+    base: str
+    queue_size: int
+    format: str
+    retention_days: int
+    max_bytes: int
+    # logger name -> { level: kept fraction }
+    sampling: MappingProxyType
+
+@dataclass(frozen=True)
+class ImagesConfig:
+    base: str
+    qr_cache_size: int
+
+@dataclass(frozen=True)
+class LampConfig:
+    cache_size: int
+    list_cache_size: int
+    cache_ttl: float
+    write_behind: bool
+    write_behind_interval_ms: int
+    write_behind_max_batch: int
+    max_waiters: int
+
+@dataclass(frozen=True)
+class TelemetryConfig:
+    buffer_size: int
+    batch_size: int
+    flush_interval_ms: int
+    retry_after: int
+    max_readings_per_request: int
+    raw_ttl_days: int
+    supply_voltage: float
+    sample_interval_ms: int
+
+@dataclass(frozen=True)
+class PasswordConfig:
+    cost: int
+    workers: int
+    max_pending: int
+
+@dataclass(frozen=True)
+class AuthConfig:
+    secret: str
+    access_ttl: int
+    refresh_ttl: int
+    device_ttl: int
+    allow_legacy_user_id: bool
+
+@dataclass(frozen=True)
+class ProfileConfig:
+    token: str
+    sample_rate: int
+    max_bytes: int
+
+@dataclass(frozen=True)
+class ServerConfig:
+    bind: str
+    workers: int
+    threads: int
+    timeout: int
+    graceful_timeout: int
+    keepalive: int
+    max_requests: int
+    max_requests_jitter: int
+
+@dataclass(frozen=True)
+class Config:
+
+    """
+    * Every setting of the backend, read once from .env and paths.yaml and validated
+    * Variables set in the process environment take precedence over .env
+    * Immutable: a reload builds a new Config, see ConfigReloader for what can change at runtime
+    """
+
+    database: DatabaseConfig
+    log: LogConfig
+    images: ImagesConfig
+    lamps: LampConfig
+    telemetry: TelemetryConfig
+    password: PasswordConfig
+    auth: AuthConfig
+    profile: ProfileConfig
+    server: ServerConfig
+
+    default_yaml_file = os.path.join("PATH_TO_YAML_FILE", "paths.yaml")
+
+    @classmethod
+    def load(cls, env_file=None, yaml_file=None):
+        env_file = env_file or dotenv.find_dotenv()
+        env = { **(dotenv.dotenv_values(env_file) if env_file else {}), **os.environ }
+
+        problems = []
+        try:
+            with open(yaml_file or cls.default_yaml_file, "r") as file:
+                content = yaml.safe_load(file) or {}
+        except (OSError, yaml.YAMLError) as ex:
+            problems.append(f"paths.yaml: {ex}")
+            content = {}
+        log = content.get("log") or {}
+        images = content.get("images") or {}
+
+        def read(source, key, cast=str, default=None, required=False, check=None, message=None, section=None):
+            value = source.get(key)
+            # paths.yaml keys are reported with their section, e.g. log.base
+            key = f"{section}.{key}" if section else key
+            if value is None or value == "":
+                if required:
+                    problems.append(f"{key} is required")
+                return default
+            try:
+                value = cast(value)
+            except (TypeError, ValueError):
+                problems.append(f"{key} must be {cast_names.get(cast, 'text')}, got {value!r}")
+                return default
+            if check is not None and not check(value):
+                problems.append(f"{key} {message}, got {value!r}")
+                return default
+            return value
+
+        def flag(value):
+            if isinstance(value, bool):
+                return value
+            if str(value).lower() in ("1", "true", "yes", "on"):
+                return True
+            if str(value).lower() in ("0", "false", "no", "off"):
+                return False
+            raise ValueError(value)
+
+        cast_names = { int: "a whole number", float: "a number", flag: "true or false" }
+
+        positive = lambda value: value > 0
+        not_negative = lambda value: value >= 0
+
+        sampling = {}
+        for logger_name, rates in (log.get("sampling") or {}).items():
+            try:
+                sampling[logger_name] = MappingProxyType({ level.upper(): float(rate) for level, rate in rates.items() })
+                if not all(0 <= rate <= 1 for rate in sampling[logger_name].values()):
+                    problems.append(f"log.sampling.{logger_name} rates must be between 0 and 1")
+            except (AttributeError, TypeError, ValueError):
+                problems.append(f"log.sampling.{logger_name} must map levels to numbers")
+
+        config = cls(
+            database=DatabaseConfig(
+                connection=read(env, "DB_CONNECTION", default="mongodb"),
+                host=read(env, "DB_HOST", default="127.0.0.1"),
+                port=read(env, "DB_PORT", int, 27017),
+                name=read(env, "DB_NAME", required=True),
+                username=read(env, "DB_USERNAME", default=""),
+                password=read(env, "DB_PASSWORD", default=""),
+                timeout_ms=read(env, "DB_TIMEOUT", int, 2000, check=positive, message="must be positive"),
+                auth_source=read(env, "DB_AUTH_SOURCE", default="admin"),
+                app_name=read(env, "DB_APP_NAME", default=""),
+                max_pool_size=read(env, "DB_MAX_POOL_SIZE", int, 100, check=positive, message="must be positive"),
+                min_pool_size=read(env, "DB_MIN_POOL_SIZE", int, 0, check=not_negative, message="must not be negative"),
+                max_idle_time_ms=read(env, "DB_MAX_IDLE_TIME_MS", int, 60000, check=positive, message="must be positive"),
+                wait_queue_timeout_ms=read(env, "DB_WAIT_QUEUE_TIMEOUT_MS", int, 5000, check=positive, message="must be positive"),
+                user_cache_size=read(env, "USER_CACHE_SIZE", int, 10000, check=positive, message="must be positive"),
+                user_cache_ttl=read(env, "USER_CACHE_TTL", float, 60.0, check=positive, message="must be positive")
+            ),
+            log=LogConfig(
+                base=read(log, "base", required=True, section="log"),
+                queue_size=read(log, "queue_size", int, 10000, check=positive, message="must be positive", section="log"),
+                format=read(log, "format", default="text", check=lambda value: value in ("text", "json"), message="must be text or json", section="log"),
+                retention_days=read(log, "retention_days", int, 30, check=not_negative, message="must not be negative", section="log"),
+                max_bytes=read(log, "max_bytes", int, 0, check=not_negative, message="must not be negative", section="log"),
+                sampling=MappingProxyType(sampling)
+            ),
+            images=ImagesConfig(
+                base=read(images, "base", required=True, section="images"),
+                qr_cache_size=read(env, "QR_CACHE_SIZE", int, 512, check=positive, message="must be positive")
+            ),
+            lamps=LampConfig(
+                cache_size=read(env, "LAMP_CACHE_SIZE", int, 10000, check=positive, message="must be positive"),
+                list_cache_size=read(env, "LAMP_LIST_CACHE_SIZE", int, 256, check=positive, message="must be positive"),
+                cache_ttl=read(env, "LAMP_CACHE_TTL", float, 5.0, check=positive, message="must be positive"),
+                write_behind=read(env, "LAMP_WRITE_BEHIND", flag, False),
+                write_behind_interval_ms=read(env, "LAMP_WRITE_BEHIND_INTERVAL_MS", int, 50, check=positive, message="must be positive"),
+                write_behind_max_batch=read(env, "LAMP_WRITE_BEHIND_MAX_BATCH", int, 1000, check=positive, message="must be positive"),
+                # Long-poll and SSE requests per worker, each holds one of the GUNICORN_THREADS threads, see gunicorn.conf.py
+                max_waiters=read(env, "LAMP_MAX_WAITERS", int, 4, check=not_negative, message="must not be negative")
+            ),
+            telemetry=TelemetryConfig(
+                buffer_size=read(env, "TELEMETRY_BUFFER_SIZE", int, 100000, check=positive, message="must be positive"),
+                batch_size=read(env, "TELEMETRY_BATCH_SIZE", int, 5000, check=positive, message="must be positive"),
+                flush_interval_ms=read(env, "TELEMETRY_FLUSH_INTERVAL_MS", int, 1000, check=positive, message="must be positive"),
+                retry_after=read(env, "TELEMETRY_RETRY_AFTER", int, 1, check=positive, message="must be positive"),
+                max_readings_per_request=read(env, "TELEMETRY_MAX_READINGS_PER_REQUEST", int, 10000, check=positive, message="must be positive"),
+                raw_ttl_days=read(env, "TELEMETRY_RAW_TTL_DAYS", int, 30, check=not_negative, message="must not be negative"),
+                supply_voltage=read(env, "TELEMETRY_SUPPLY_VOLTAGE", float, 5.0, check=positive, message="must be positive"),
+                sample_interval_ms=read(env, "TELEMETRY_SAMPLE_INTERVAL_MS", int, 1000, check=positive, message="must be positive")
+            ),
+            password=PasswordConfig(
+                cost=read(env, "BCRYPT_COST", int, 12, check=lambda value: 4 <= value <= 31, message="must be between 4 and 31"),
+                workers=read(env, "BCRYPT_WORKERS", int, 2, check=positive, message="must be positive"),
+                max_pending=read(env, "BCRYPT_MAX_PENDING", int, 32, check=not_negative, message="must not be negative")
+            ),
+            auth=AuthConfig(
+                secret=read(env, "JWT_SECRET"),
+                access_ttl=read(env, "JWT_ACCESS_TTL", int, 900, check=positive, message="must be positive"),
+                refresh_ttl=read(env, "JWT_REFRESH_TTL", int, 1209600, check=positive, message="must be positive"),
+                device_ttl=read(env, "AUTH_DEVICE_TTL", int, 31536000, check=positive, message="must be positive"),
+                # Deprecated: accepts requests with a bare (forgeable) user id and no token, only for old clients
+                # during their move to tokens, board controllers use device tokens (/api/device_token)
+                allow_legacy_user_id=read(env, "AUTH_ALLOW_LEGACY_USER_ID", flag, False)
+            ),
+            profile=ProfileConfig(
+                token=read(env, "PROFILE_TOKEN"),
+                sample_rate=read(env, "PROFILE_SAMPLE_RATE", int, 0, check=not_negative, message="must not be negative"),
+                max_bytes=read(env, "PROFILE_MAX_BYTES", int, 104857600, check=positive, message="must be positive")
+            ),
+            server=ServerConfig(
+                bind=read(env, "GUNICORN_BIND", default="0.0.0.0:5000"),
+                workers=read(env, "GUNICORN_WORKERS", int, 1, check=positive, message="must be positive"),
+                threads=read(env, "GUNICORN_THREADS", int, 8, check=positive, message="must be positive"),
+                timeout=read(env, "GUNICORN_TIMEOUT", int, 90, check=positive, message="must be positive"),
+                graceful_timeout=read(env, "GUNICORN_GRACEFUL_TIMEOUT", int, 30, check=positive, message="must be positive"),
+                keepalive=read(env, "GUNICORN_KEEPALIVE", int, 5, check=not_negative, message="must not be negative"),
+                max_requests=read(env, "GUNICORN_MAX_REQUESTS", int, 0, check=not_negative, message="must not be negative"),
+                max_requests_jitter=read(env, "GUNICORN_MAX_REQUESTS_JITTER", int, 0, check=not_negative, message="must not be negative")
+            )
+        )
+
+        # Waiters must leave threads for logins and writes, 0 (no limit) is only for servers without a thread pool
+        if config.lamps.max_waiters and config.server.threads and config.lamps.max_waiters >= config.server.threads:
+            problems.append(f"LAMP_MAX_WAITERS must be below GUNICORN_THREADS ({config.server.threads}), got {config.lamps.max_waiters}")
+
+        if problems:
+            raise ConfigError(problems)
+        return config
+
+class ConfigReloader:
+
+    """
+    * Holds the current Config and swaps in a freshly loaded one on reload() or SIGHUP
+    * Subscribers apply the hot-swappable settings:
+    *   log sampling, bcrypt cost, JWT lifetimes, legacy user ids, user cache ttl and profiling
+    * Other changes (database, paths, pool and queue sizes, JWT secret) are logged and need a restart
+    * An invalid file keeps the current Config
+    """
+
+    reloadable = {
+        "log": ("sampling",),
+        "password": ("cost",),
+        "auth": ("access_ttl", "refresh_ttl", "device_ttl", "allow_legacy_user_id"),
+        "database": ("user_cache_ttl",),
+        "profile": ("token", "sample_rate")
+    }
+
+    def __init__(self, logging, config, loader=Config.load) -> None:
+        self.logging = logging
+        self.config = config
+        self.loader = loader
+        self.callbacks = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback):
+        self.callbacks.append(callback)
+
+    def reload(self):
+        with self._lock:
+            try:
+                config = self.loader()
+            except ConfigError as ex:
+                self.logging.log_debug(f"Class: ConfigReloader | Method: reload | ErorMsg: {ex}")
+                return False
+
+            restart_needed = []
+            for section in dataclasses.fields(Config):
+                old_section = getattr(self.config, section.name)
+                new_section = getattr(config, section.name)
+                for field in dataclasses.fields(old_section):
+                    if getattr(old_section, field.name) != getattr(new_section, field.name) and field.name not in self.reloadable.get(section.name, ()):
+                        restart_needed.append(f"{section.name}.{field.name}")
+            if restart_needed:
+                self.logging.log_debug(f"Class: ConfigReloader | Method: reload | Restart needed for: {', '.join(restart_needed)}")
+
+            self.config = config
+            for callback in self.callbacks:
+                callback(config)
+            return True
+
+    def install(self, signum=signal.SIGHUP):
+        # Signal handlers can only be set from the main thread, e.g. not under the benchmark's server thread
+        if threading.current_thread() is not threading.main_thread():
+            return False
+        signal.signal(signum, lambda signum, frame: threading.Thread(target=self.reload, name="config-reload", daemon=True).start())
+        return True
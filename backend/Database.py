@@ -1,47 +1,306 @@
 import os
-import urllib.parse
+import time
+import threading
+from contextlib import contextmanager
 import pymongo
-import dotenv
+import pymongo.errors
+from Cache import Cache
+from Metrics import MongoCommandListener
 
 class Database:
-    
+
     """
     * This Class Resposible to create collection in MongoDB Database
     * Define the collection name in this class
+    * One MongoClient (with its connection pool) is shared by the whole process
     """
-    
+
     collection_names = [
         "users",
         "lamps",
-        "deleted_datas"
+        "deleted_datas",
+        "counters",
+        "lamp_readings",
+        "lamp_energy_hourly",
+        "lamp_energy_daily"
     ]
-    
-    def __init__(self, logging) -> None:
+
+    # Time-series collections created at startup, keyed by collection name
+    # Options are the timeseries argument of create_collection
+    time_series_collections = {
+        "lamp_readings": {"timeField": "ts", "metaField": "meta", "granularity": "seconds"}
+    }
+
+    # Indexes ensured at startup, keyed by collection name
+    # Each entry is (keys, options) as accepted by create_index
+    collection_indexes = {
+        "users": [
+            ([("email", pymongo.ASCENDING)], {"name": "email_unique", "unique": True})
+        ],
+        # Lamps are always queried by owner (created_by), LEDs are unique per owner
+        "lamps": [
+            ([("created_by", pymongo.ASCENDING), ("led", pymongo.ASCENDING)], {"name": "created_by_led_unique", "unique": True}),
+            ([("created_by", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)], {"name": "created_by_id"}),
+            ([("created_by", pymongo.ASCENDING), ("updated_at", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)], {"name": "created_by_updated_at_id"}),
+            ([("created_by", pymongo.ASCENDING), ("version", pymongo.ASCENDING)], {"name": "created_by_version"}),
+            ([("qr_id", pymongo.ASCENDING)], {"name": "qr_id"})
+        ],
+        "deleted_datas": [
+            ([("deleted_by", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)], {"name": "deleted_by_id"}),
+            ([("deleted_by", pymongo.ASCENDING), ("version", pymongo.ASCENDING)], {"name": "deleted_by_version"})
+        ],
+        "lamp_energy_hourly": [
+            ([("user", pymongo.ASCENDING), ("start", pymongo.ASCENDING), ("led", pymongo.ASCENDING)], {"name": "user_start_led_unique", "unique": True})
+        ],
+        "lamp_energy_daily": [
+            ([("user", pymongo.ASCENDING), ("start", pymongo.ASCENDING), ("led", pymongo.ASCENDING)], {"name": "user_start_led_unique", "unique": True})
+        ]
+    }
+
+    # Indexes replaced by the ones above, dropped at startup when they still exist
+    obsolete_indexes = {
+        "lamps": ["led_unique", "created_by", "updated_at_id", "version"],
+        "deleted_datas": ["deleted_by", "version"]
+    }
+
+    # Versions left open by writers that died stop holding back committed_version() once the owner's counter
+    # has been idle this long
+    version_lease_seconds = 60
+
+    # Process-wide client and cached collection handles
+    # _pid is the process that built the client, a forked worker builds its own
+    _client = None
+    _pid = None
+    _collections = {}
+    _lock = threading.Lock()
+    # Last seq of the pre per-owner "lamps" counter, see version_base
+    _version_base = None
+
+    def __init__(self, logging, config, client=None, metrics=None) -> None:
         self.logging = logging
-    
+        self.config = config
+        self.metrics = metrics
+
+        # An already built client (e.g. mongomock in tests) replaces the shared one
+        if client is not None:
+            Database._client = client
+            Database._pid = os.getpid()
+            Database._collections = {}
+            Database._version_base = None
+
+        self.db_name = config.name
+
+        # Validated user ids, shared by every API that checks the user_id parameter
+        self.user_cache = Cache(max_size=config.user_cache_size, ttl=config.user_cache_ttl)
+
+    def get_client(self):
+        if Database._client is not None and Database._pid == os.getpid():
+            return Database._client
+
+        with Database._lock:
+            if Database._client is not None and Database._pid != os.getpid():
+                # Inherited through fork, its sockets belong to the parent process
+                Database._client = None
+                Database._collections = {}
+
+            # Another thread may have created the client while we were waiting
+            if Database._client is None:
+                options = self.get_pool_options()
+                if self.metrics is not None:
+                    options["event_listeners"] = [MongoCommandListener(self.metrics)]
+                Database._client = pymongo.MongoClient(self.get_uri(), **options)
+                Database._pid = os.getpid()
+            return Database._client
+
+    def get_uri(self):
+        # Generated from the DB_* variables in the env file
+        return self.config.uri
+
+    def get_pool_options(self):
+        # Connection pool settings, see .env.example for the defaults
+        return {
+            "maxPoolSize": self.config.max_pool_size,
+            "minPoolSize": self.config.min_pool_size,
+            "maxIdleTimeMS": self.config.max_idle_time_ms,
+            "waitQueueTimeoutMS": self.config.wait_queue_timeout_ms
+        }
+
     def database_connection(self, collection_name):
         try:
-            # Load environment variables from the .env file (if present)
-            dotenv.load_dotenv()
-            DB_CONNECTION = os.getenv("DB_CONNECTION")
-            DB_HOST = os.getenv("DB_HOST")
-            DB_PORT = os.getenv("DB_PORT")
-            DB_NAME = os.getenv("DB_NAME")
-            DB_USERNAME = os.getenv("DB_USERNAME")
-            DB_PASSWORD = os.getenv("DB_PASSWORD")
-            DB_TIMEOUT = os.getenv("DB_TIMEOUT")
-            DB_AUTH_SOURCE = os.getenv("DB_AUTH_SOURCE")
-            DB_APP_NAME = os.getenv("DB_APP_NAME")
-            
-            # Generate uri from the env file
-            MONGODB_URI = f"{DB_CONNECTION}://{DB_USERNAME}:{urllib.parse.quote(DB_PASSWORD)}@{DB_HOST}:{DB_PORT}/{DB_NAME}?directConnection=true&serverSelectionTimeoutMS={DB_TIMEOUT}&authSource={DB_AUTH_SOURCE}&appName={DB_APP_NAME}"
-            connection = pymongo.MongoClient(MONGODB_URI)
-            database = connection[DB_NAME]
+            client = self.get_client()
+            collection = Database._collections.get(collection_name)
+            if collection is not None:
+                return collection
+
             if collection_name not in self.collection_names:
                 self.logging.log_debug(f"{collection_name} does not exists.")
-                
+
+            database = client[self.db_name]
             collection = database[collection_name]
+            Database._collections[collection_name] = collection
             return collection
-        
+
         except Exception as ex:
-            self.logging.log_debug(f"Class: Database | Method: database_connection | ErorMsg: {ex}")
\ No newline at end of file
+            self.logging.log_debug(f"Class: Database | Method: database_connection | ErorMsg: {ex}")
+
+    def user_exists(self, object_user_id):
+        user_id = str(object_user_id)
+        if self.user_cache.get(user_id):
+            return True
+
+        # Only the _id is needed to know the user exists
+        user_collection = self.database_connection("users")
+        user = user_collection.find_one({ "_id": object_user_id }, { "_id": 1 })
+        if not user:
+            return False
+
+        self.user_cache.set(user_id, True)
+        return True
+
+    def version_counter(self, owner):
+        # Delta sync is per owner, so each owner has its own counter and writers of different owners never contend
+        return f"lamps:{owner}"
+
+    def version_base(self):
+        # Versions taken from the single counter used before per-owner counters, new counters continue above it
+        # so marks clients already hold stay valid. Read once, nothing increments that counter anymore
+        if Database._version_base is None:
+            legacy = self.database_connection("counters").find_one({ "_id": "lamps" }, { "seq": 1 })
+            Database._version_base = legacy["seq"] if legacy else 0
+        return Database._version_base
+
+    @contextmanager
+    def next_version(self, owner):
+        # Monotonic per owner across every worker, one document per owner in the counters collection
+        # Use as `with database.next_version(owner) as version:` around the write that stores it
+        # open counts the versions taken but not written yet, committed_version() stays below them
+        counter_name = self.version_counter(owner)
+        update = [{ "$set": {
+            "seq": { "$add": [{ "$ifNull": ["$seq", self.version_base()] }, 1] },
+            "open": { "$add": [{ "$ifNull": ["$open", 0] }, 1] },
+            "touched_at": time.time()
+        } }]
+        try:
+            counter = self.database_connection("counters").find_one_and_update(
+                { "_id": counter_name }, update, upsert=True, return_document=pymongo.ReturnDocument.AFTER
+            )
+        except pymongo.errors.DuplicateKeyError:
+            # Two first writes for the owner raced on the upsert, the counter exists now so the retry updates it
+            counter = self.database_connection("counters").find_one_and_update(
+                { "_id": counter_name }, update, return_document=pymongo.ReturnDocument.AFTER
+            )
+        try:
+            yield counter["seq"]
+        finally:
+            self.release_version(counter_name)
+
+    def release_version(self, counter_name):
+        # One atomic update: the last writer out moves floor up to seq, every version up to it is written then
+        self.database_connection("counters").update_one({ "_id": counter_name }, [
+            { "$set": { "open": { "$max": [{ "$subtract": ["$open", 1] }, 0] }, "touched_at": time.time() } },
+            { "$set": { "floor": { "$cond": [{ "$eq": ["$open", 0] }, "$seq", { "$ifNull": ["$floor", 0] }] } } }
+        ])
+
+    def committed_version(self, owner):
+        # Every version up to the returned one is written, so `version > mark` never skips a write
+        # While writes are in flight this is the last mark seen with none open (floor)
+        counter_name = self.version_counter(owner)
+        counter_collection = self.database_connection("counters")
+        counter = counter_collection.find_one({ "_id": counter_name })
+        if counter is None:
+            return self.version_base()
+        if not counter.get("open"):
+            return counter["seq"]
+        if counter["touched_at"] < time.time() - self.version_lease_seconds:
+            # No version taken or released for a whole lease: what is still open belongs to writers that died
+            counter_collection.update_one(
+                { "_id": counter_name, "seq": counter["seq"], "touched_at": counter["touched_at"] },
+                { "$set": { "open": 0, "floor": counter["seq"] } }
+            )
+            return counter["seq"]
+        return counter.get("floor", self.version_base())
+
+    def invalidate_user(self, user_id):
+        self.user_cache.invalidate(str(user_id))
+
+    def warm_up(self, expire_after=None):
+        # Opens the pool and ensures indexes so the first request does not pay for it
+        try:
+            self.get_client().admin.command("ping")
+        except pymongo.errors.PyMongoError as ex:
+            self.logging.log_debug(f"Class: Database | Method: warm_up | ErorMsg: {ex}")
+            return False
+        self.ensure_time_series(expire_after)
+        self.ensure_indexes()
+        return True
+
+    def ensure_time_series(self, expire_after=None):
+        # Time-series collections must be created explicitly, an insert would create a plain one
+        # expire_after maps a collection name to its TTL in seconds, 0 or missing keeps documents forever
+        expire_after = expire_after or {}
+        try:
+            database = self.get_client()[self.db_name]
+            existing = { info["name"]: info.get("options", {}) for info in database.list_collections() }
+        except Exception as ex:
+            # PyMongoError, or NotImplementedError from mongomock in the benchmark
+            self.logging.log_debug(f"Class: Database | Method: ensure_time_series | ErorMsg: {ex}")
+            return
+
+        for collection_name, options in self.time_series_collections.items():
+            seconds = expire_after.get(collection_name) or None
+            try:
+                if collection_name not in existing:
+                    if seconds:
+                        database.create_collection(collection_name, timeseries=options, expireAfterSeconds=seconds)
+                    else:
+                        database.create_collection(collection_name, timeseries=options)
+                elif existing[collection_name].get("expireAfterSeconds") != seconds:
+                    # TTL changed in the config, collMod applies it to the existing collection
+                    database.command("collMod", collection_name, expireAfterSeconds=seconds or "off")
+            except pymongo.errors.CollectionInvalid:
+                # Created by another worker meanwhile
+                pass
+            except Exception as ex:
+                # e.g. a server older than 5.0, inserts then create a plain collection
+                self.logging.log_debug(f"Class: Database | Method: ensure_time_series | Collection: {collection_name} | ErorMsg: {ex}")
+
+    def ensure_indexes(self):
+        # create_index is a no-op when an identical index already exists
+        failed = set()
+        for collection_name, indexes in self.collection_indexes.items():
+            collection = self.database_connection(collection_name)
+            for keys, options in indexes:
+                try:
+                    collection.create_index(keys, **options)
+                except pymongo.errors.ConnectionFailure as ex:
+                    # No point trying the remaining indexes without a server
+                    self.logging.log_debug(f"Class: Database | Method: ensure_indexes | ErorMsg: {ex}")
+                    return
+                except pymongo.errors.PyMongoError as ex:
+                    self.logging.log_debug(f"Class: Database | Method: ensure_indexes | Index: {collection_name}.{options['name']} | ErorMsg: {ex}")
+                    failed.add(collection_name)
+
+        # Only once every replacement is built, e.g. led_unique stays until created_by_led_unique exists
+        for collection_name, index_names in self.obsolete_indexes.items():
+            if collection_name in failed:
+                continue
+            collection = self.database_connection(collection_name)
+            try:
+                existing = collection.index_information()
+            except pymongo.errors.PyMongoError as ex:
+                self.logging.log_debug(f"Class: Database | Method: ensure_indexes | ErorMsg: {ex}")
+                return
+            for index_name in index_names:
+                if index_name not in existing:
+                    continue
+                try:
+                    collection.drop_index(index_name)
+                except pymongo.errors.PyMongoError as ex:
+                    self.logging.log_debug(f"Class: Database | Method: ensure_indexes | Index: {collection_name}.{index_name} | ErorMsg: {ex}")
+
+    def close_connection(self):
+        with Database._lock:
+            if Database._client is not None:
+                Database._client.close()
+            Database._client = None
+            Database._collections = {}
\ No newline at end of file
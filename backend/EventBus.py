@@ -0,0 +1,63 @@
+import time
+import threading
+from collections import deque
+
+class EventBus:
+
+    """
+    * In-process publish/subscribe for lamp changes
+    * Every published event gets a monotonic version; waiters block until a newer version exists
+    * Only the last max_events events are kept, older versions ask the client to resync
+    """
+
+    def __init__(self, max_events=1024) -> None:
+        self._condition = threading.Condition()
+        self._events = deque(maxlen=max_events)
+        self._version = 0
+        self._closed = False
+
+    @property
+    def version(self):
+        return self._version
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def publish(self, topic, payload):
+        with self._condition:
+            event = {
+                "version": self._version + 1,
+                "topic": topic,
+                "data": payload
+            }
+
+            self._version = event["version"]
+            self._events.append(event)
+            self._condition.notify_all()
+        return event["version"]
+
+    def events_since(self, since, topic=None):
+        # None means the client is too far behind (or ahead, after a restart) and must resync
+        if since > self._version or (self._events and since < self._events[0]["version"] - 1):
+            return None
+        return [
+            event for event in self._events
+            if event["version"] > since and (topic is None or event["topic"] == topic)
+        ]
+
+    def wait(self, since, timeout, topic=None):
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                events = self.events_since(since, topic)
+                remaining = deadline - time.monotonic()
+                if events is None or events or remaining <= 0 or self._closed:
+                    return self._version, events
+                self._condition.wait(remaining)
+
+    def close(self):
+        # Release every blocked waiter, used on shutdown
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
\ No newline at end of file
@@ -1,14 +1,92 @@
 import os
-import yaml
+import json
+import queue
+import random
 import logging
 import logging.handlers as handler
 import datetime
+import gzip
+import shutil
+import threading
+import time
+
+class LogCompressor:
+
+    """
+    * Gzips rotated log files and enforces retention on a background thread
+    * Retention walks every month folder, so old days are found wherever they live
+    """
+
+    def __init__(self, base_log_path, retention_days) -> None:
+        self.base_log_path = base_log_path
+        self.retention_days = retention_days
+        self.pending = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="log-compressor", daemon=True)
+        self.thread.start()
+
+    def submit(self, log_file):
+        self.pending.put(log_file)
+
+    def run(self):
+        while True:
+            log_file = self.pending.get()
+            try:
+                if log_file is not None:
+                    self.compress(log_file)
+                self.prune()
+            except OSError:
+                # Nowhere to report it, the file is retried on the next start
+                pass
+            finally:
+                self.pending.task_done()
+
+    def compress(self, log_file):
+        if not os.path.exists(log_file):
+            return
+        modified_at = os.path.getmtime(log_file)
+        with open(log_file, "rb") as source, gzip.open(f"{log_file}.gz", "wb") as target:
+            shutil.copyfileobj(source, target)
+        # Keep the original time so retention counts from when the log was written
+        os.utime(f"{log_file}.gz", (modified_at, modified_at))
+        os.remove(log_file)
+
+    def prune(self):
+        if self.retention_days <= 0:
+            return
+
+        oldest = time.time() - self.retention_days * 86400
+        for month_folder in os.listdir(self.base_log_path):
+            log_dir = os.path.join(self.base_log_path, month_folder)
+            if not os.path.isdir(log_dir):
+                continue
+            for filename in os.listdir(log_dir):
+                log_file = os.path.join(log_dir, filename)
+                if filename.endswith(".gz") and os.path.getmtime(log_file) < oldest:
+                    os.remove(log_file)
+            if not os.listdir(log_dir):
+                os.rmdir(log_dir)
+
+    def flush(self):
+        self.pending.join()
 
 class CustomTimedRotatingFileHandler(handler.TimedRotatingFileHandler):
-    def __init__(self, base_log_path, when="midnight", interval=1, backupCount=30):
+
+    """
+    * Writes <base>/<Mon>/<dd-mm-YYYY>.log and starts a new file at midnight
+    * Also rolls over when the file reaches maxBytes, the full file becomes <dd-mm-YYYY>.<n>.log
+    * Closed files are handed to LogCompressor, backupCount is the retention in days
+    """
+
+    def __init__(self, base_log_path, when="midnight", interval=1, backupCount=30, maxBytes=0):
         self.base_log_path = base_log_path
+        self.maxBytes = maxBytes
         super().__init__(self._get_log_file(), when, interval, backupCount)
-    
+        self.compressor = LogCompressor(base_log_path, backupCount)
+
+        # Files left uncompressed by an earlier process (e.g. a crash before compression)
+        for log_file in self._get_rotated_files():
+            self.compressor.submit(log_file)
+
     def _get_log_file(self):
         current_time = datetime.datetime.now()
         month_folder = current_time.strftime("%b")
@@ -18,41 +96,190 @@ class CustomTimedRotatingFileHandler(handler.TimedRotatingFileHandler):
         log_file = os.path.join(log_dir, current_time.strftime("%d-%m-%Y.log"))
         return log_file
 
+    def _get_rotated_files(self):
+        rotated_files = []
+        for month_folder in os.listdir(self.base_log_path):
+            log_dir = os.path.join(self.base_log_path, month_folder)
+            if not os.path.isdir(log_dir):
+                continue
+            for filename in os.listdir(log_dir):
+                log_file = os.path.join(log_dir, filename)
+                if filename.endswith(".log") and os.path.abspath(log_file) != self.baseFilename:
+                    rotated_files.append(log_file)
+        return rotated_files
+
+    def shouldRollover(self, record):
+        if super().shouldRollover(record):
+            return True
+        if self.maxBytes > 0 and self.stream is not None:
+            message = f"{self.format(record)}{self.terminator}"
+            return self.stream.tell() + len(message) >= self.maxBytes
+        return False
+
     def doRollover(self):
-        self.baseFilename = self._get_log_file()
-        super().doRollover()
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+
+        previous_file = self.baseFilename
+        self.baseFilename = os.path.abspath(self._get_log_file())
+        if self.baseFilename == previous_file:
+            # Size rollover within the same day, move the full file aside
+            stem = previous_file[:-len(".log")]
+            index = 1
+            while os.path.exists(f"{stem}.{index}.log") or os.path.exists(f"{stem}.{index}.log.gz"):
+                index += 1
+            os.rename(previous_file, f"{stem}.{index}.log")
+            previous_file = f"{stem}.{index}.log"
+        self.compressor.submit(previous_file)
+
+        if not self.delay:
+            self.stream = self._open()
+
+        current_time = int(time.time())
+        rollover_at = self.computeRollover(current_time)
+        while rollover_at <= current_time:
+            rollover_at += self.interval
+        self.rolloverAt = rollover_at
+
+class BoundedQueueHandler(handler.QueueHandler):
+
+    """
+    * Puts records on a bounded queue without ever blocking the caller
+    * Records that do not fit are dropped and counted
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class SamplingFilter(logging.Filter):
+
+    """
+    * Keeps a fraction of the records per level, e.g. { "INFO": 0.1 } keeps one INFO record in ten
+    * Levels that are not listed are always kept
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = { logging.getLevelName(level.upper()): float(rate) for level, rate in rates.items() }
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno, 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+class JsonFormatter(logging.Formatter):
+
+    """
+    * One JSON object per line, with the structured fields passed through `extra`
+    """
+
+    structured_fields = ["route", "method", "status", "latency_ms"]
+
+    def format(self, record):
+        content = {
+            "time": self.formatTime(record, "%Y-%m-%d %H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        for field in self.structured_fields:
+            if hasattr(record, field):
+                content[field] = getattr(record, field)
+        return json.dumps(content)
 
 class Logger:
-    
-    def __init__(self) -> None:
-        with open(os.path.join("PATH_TO_YAML_FILE", "paths.yaml"), "r") as file:
-            content = yaml.safe_load(file)
-            
-        # Access specific paths
-        self.base_log_path = content["log"]["base"]
-        
+
+    def __init__(self, config) -> None:
+        # Log settings from paths.yaml, see Config.LogConfig
+        self.base_log_path = config.base
+        self.queue_size = config.queue_size
+        self.log_format = config.format
+        self.sampling = config.sampling
+        self.retention_days = config.retention_days
+        self.max_bytes = config.max_bytes
+
         # Set up logger
         self.setup_logger()
-        
+
     def setup_logger(self):
-        logger = logging.getLogger("debug_logger")
-        logger.setLevel(logging.DEBUG)
-        
-        # Define a CustomTimedRotatingFileHandler
-        handler = CustomTimedRotatingFileHandler(
-            self.base_log_path, when="midnight", interval=1, backupCount=30
+        # Only the background listener thread touches the file
+        self.file_handler = file_handler = CustomTimedRotatingFileHandler(
+            self.base_log_path, when="midnight", interval=1, backupCount=self.retention_days, maxBytes=self.max_bytes
         )
-        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S"))
-        logger.addHandler(handler)
-        
+        if self.log_format == "json":
+            file_handler.setFormatter(JsonFormatter())
+        else:
+            file_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S"))
+
+        self.queue_handler = BoundedQueueHandler(queue.Queue(self.queue_size))
+        self.listener = handler.QueueListener(self.queue_handler.queue, file_handler)
+        self.listener.start()
+
+        self.sampled_handlers = {}
+        self.retired_dropped = 0
+        self.logger = self.attach("debug_logger", logging.DEBUG)
+        self.access_logger = self.attach("access_logger", logging.INFO)
+
         # Setup werkzeug to use this logger
-        werkzeug_logger = logging.getLogger('werkzeug')
-        werkzeug_logger.setLevel(logging.INFO)
-        werkzeug_logger.addHandler(handler)
-    
+        self.attach("werkzeug", logging.INFO)
+
+    def attach(self, name, level):
+        logger = logging.getLogger(name)
+        logger.setLevel(level)
+        logger.propagate = False
+
+        queue_handler = self.queue_handler
+        if name in self.sampling:
+            # Each sampled logger gets its own handler so the filter stays local to it
+            queue_handler = BoundedQueueHandler(self.queue_handler.queue)
+            queue_handler.addFilter(SamplingFilter(self.sampling[name]))
+
+        previous_handler = self.sampled_handlers.pop(name, None)
+        if previous_handler is not None:
+            self.retired_dropped += previous_handler.dropped
+        if queue_handler is not self.queue_handler:
+            self.sampled_handlers[name] = queue_handler
+
+        # Replaces handlers left by an earlier Logger or sampling, in one assignment so no record is lost
+        logger.handlers = [queue_handler]
+        return logger
+
+    def set_sampling(self, sampling):
+        # Hot reload of the sampling rates, see ConfigReloader
+        self.sampling = sampling
+        self.attach("debug_logger", logging.DEBUG)
+        self.attach("access_logger", logging.INFO)
+        self.attach("werkzeug", logging.INFO)
+
     def get_logger(self):
-        return logging.getLogger("debug_logger")
+        return self.logger
 
     def log_debug(self, message):
-        logger = self.get_logger()
-        logger.debug(message)
\ No newline at end of file
+        self.logger.debug(message)
+
+    def log_request(self, route, method, status, latency_ms):
+        self.access_logger.info(
+            f"{method} {route} {status} {latency_ms:.1f}ms",
+            extra={ "route": route, "method": method, "status": status, "latency_ms": round(latency_ms, 3) }
+        )
+
+    def stats(self):
+        handlers = [self.queue_handler] + list(self.sampled_handlers.values())
+        return {
+            "queued": self.queue_handler.queue.qsize(),
+            "dropped": self.retired_dropped + sum(queue_handler.dropped for queue_handler in handlers)
+        }
+
+    def stop(self):
+        # Flushes what is still queued, call on shutdown
+        if self.listener._thread is not None:
+            self.listener.stop()
+            self.file_handler.close()
+            self.file_handler.compressor.flush()
\ No newline at end of file
@@ -0,0 +1,186 @@
+import time
+import bisect
+import threading
+import pymongo.monitoring
+from flask import Response, request, g
+
+class Counter:
+
+    def __init__(self, name, description, label_names=()) -> None:
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, labels, value) for labels, value in self.values.items()]
+
+class Gauge(Counter):
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self.values[labels] = value
+
+class Histogram:
+
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, description, label_names=(), buckets=default_buckets) -> None:
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts..., +Inf count, sum]
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            items = [(labels, list(counts)) for labels, counts in self.values.items()]
+        for labels, counts in items:
+            cumulative = 0
+            for bucket, count in zip(self.buckets + ("+Inf",), counts[:-1]):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", labels + (("le", str(bucket)),), cumulative))
+            samples.append((f"{self.name}_count", labels, cumulative))
+            samples.append((f"{self.name}_sum", labels, counts[-1]))
+        return samples
+
+class MongoCommandListener(pymongo.monitoring.CommandListener):
+
+    """
+    * Counts Mongo commands and their durations, registered on the shared MongoClient
+    """
+
+    def __init__(self, metrics) -> None:
+        self.durations = metrics.histogram(
+            "mongo_command_duration_seconds", "Mongo command duration in seconds.", ("command", "outcome")
+        )
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.durations.observe(event.duration_micros / 1e6, (("command", event.command_name), ("outcome", "success")))
+
+    def failed(self, event):
+        self.durations.observe(event.duration_micros / 1e6, (("command", event.command_name), ("outcome", "failure")))
+
+class Metrics:
+
+    """
+    * Minimal in-process metrics registry rendered in the Prometheus text format
+    * Labels are tuples of (name, value) pairs so recording is a dict lookup under a short lock
+    * Collectors are callables returning extra (name, type, help, samples) families at scrape time
+    """
+
+    def __init__(self) -> None:
+        self.families = []
+        self.collectors = []
+        self.requests_in_flight = self.gauge("http_requests_in_flight", "Requests currently being served.")
+        self.request_duration = self.histogram(
+            "http_request_duration_seconds", "Request latency in seconds.", ("blueprint", "route", "method", "status")
+        )
+
+    def counter(self, name, description, label_names=()):
+        return self.register(Counter(name, description, label_names), "counter")
+
+    def gauge(self, name, description, label_names=()):
+        return self.register(Gauge(name, description, label_names), "gauge")
+
+    def histogram(self, name, description, label_names=(), buckets=Histogram.default_buckets):
+        return self.register(Histogram(name, description, label_names, buckets), "histogram")
+
+    def register(self, metric, metric_type):
+        self.families.append((metric, metric_type))
+        return metric
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def init_app(self, app):
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+        app.add_url_rule("/metrics", "metrics", self.metrics_view, methods=["GET"])
+
+    def before_request(self):
+        g.metrics_started = time.perf_counter()
+        self.requests_in_flight.inc()
+
+    def after_request(self, response):
+        started = g.get("metrics_started")
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            labels = (
+                ("blueprint", request.blueprint or ""),
+                ("route", route),
+                ("method", request.method),
+                ("status", str(response.status_code))
+            )
+            self.request_duration.observe(time.perf_counter() - started, labels)
+        return response
+
+    def teardown_request(self, exception):
+        if g.pop("metrics_started", None) is not None:
+            self.requests_in_flight.dec()
+
+    def metrics_view(self):
+        return Response(self.render(), mimetype="text/plain; version=0.0.4")
+
+    def render(self):
+        lines = []
+        families = [
+            (metric.name, metric_type, metric.description, metric.samples())
+            for metric, metric_type in self.families
+        ]
+        for collector in self.collectors:
+            families.extend(collector())
+
+        for name, metric_type, description, samples in families:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for sample_name, labels, value in samples:
+                if labels:
+                    label_text = ",".join(f'{key}="{self.escape(label)}"' for key, label in labels)
+                    lines.append(f"{sample_name}{{{label_text}}} {value}")
+                else:
+                    lines.append(f"{sample_name} {value}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class Timer:
+
+    def __init__(self, histogram, labels) -> None:
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.histogram.observe(time.perf_counter() - self.started, self.labels)
+        return False
\ No newline at end of file
@@ -0,0 +1,71 @@
+import threading
+import bcrypt
+from concurrent.futures import ThreadPoolExecutor
+from Metrics import Timer
+
+class PasswordHasherBusy(Exception):
+
+    """
+    * Raised when the password queue is full, the API answers 429 with Retry-After
+    """
+
+    def __init__(self, retry_after) -> None:
+        super().__init__("Too many password requests. Please try again later.")
+        self.retry_after = retry_after
+
+class PasswordHasher:
+
+    """
+    * Runs bcrypt hashing and verification on a small dedicated thread pool
+    * bcrypt releases the GIL, so request threads keep serving lamp calls meanwhile
+    * At most workers + max_pending calls are admitted, the rest fail fast with PasswordHasherBusy
+    """
+
+    def __init__(self, logging, cost=12, workers=2, max_pending=32, retry_after=1, metrics=None) -> None:
+        self.logging = logging
+        self.durations = None
+        if metrics is not None:
+            self.durations = metrics.histogram(
+                "password_hash_duration_seconds", "bcrypt time in seconds, excluding queueing.", ("operation",)
+            )
+        self.cost = cost
+        self.retry_after = retry_after
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+
+    def _run(self, function, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy(self.retry_after)
+
+        try:
+            future = self._executor.submit(self._timed, function, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda future: self._slots.release())
+        return future.result()
+
+    def _timed(self, function, *args):
+        if self.durations is None:
+            return function(*args)
+        with Timer(self.durations, (("operation", function.__name__),)):
+            return function(*args)
+
+    def hash(self, password):
+        # The cost is the number that dictates the 'slowness'
+        hash_password = self._run(bcrypt.hashpw, password.encode("utf-8"), bcrypt.gensalt(self.cost))
+        # decode the hash to prevent is encoded twice
+        return hash_password.decode("utf-8")
+
+    def verify(self, password, hash_password):
+        return self._run(bcrypt.checkpw, password.encode("utf-8"), hash_password.encode("utf-8"))
+
+    def needs_rehash(self, hash_password):
+        # Hash layout is $2b$<cost>$<salt and hash>
+        try:
+            return int(hash_password.split("$")[2]) != self.cost
+        except (IndexError, ValueError):
+            return True
+
+    def close(self):
+        self._executor.shutdown(wait=True)
\ No newline at end of file
@@ -0,0 +1,120 @@
+import os
+import re
+import json
+import time
+import cProfile
+import datetime
+import itertools
+import threading
+from flask import request, g
+
+class Profiler:
+
+    """
+    * Opt-in cProfile around single requests
+    * A request is profiled when it sends "X-Profile: <token>" or, with sample_rate N, one in every N requests
+    * Output: <log base>/profiles/<route>/<timestamp>.pstats plus one line per profile in profiles/index.jsonl
+    * The oldest profiles are deleted once the folder is over max_bytes
+    * Load a profile with pstats, snakeviz or flameprof (flame graph)
+    """
+
+    header = "X-Profile"
+
+    def __init__(self, logging, base_log_path, token=None, sample_rate=0, max_bytes=100 * 1024 * 1024) -> None:
+        self.logging = logging
+        self.profile_path = os.path.join(base_log_path, "profiles")
+        self.token = token
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.token) or self.sample_rate > 0
+
+    def init_app(self, app):
+        # Installed even when disabled, a config reload may turn profiling on
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+    def should_profile(self):
+        if not self.enabled:
+            return False
+        if self.token and request.headers.get(self.header) == self.token:
+            return True
+        return self.sample_rate > 0 and next(self._counter) % self.sample_rate == 0
+
+    def before_request(self):
+        if not self.should_profile():
+            return
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already active on this interpreter
+            return
+        g.profile = profile
+        g.profile_started = time.perf_counter()
+
+    def after_request(self, response):
+        profile = g.pop("profile", None)
+        if profile is None:
+            return response
+
+        profile.disable()
+        duration_ms = (time.perf_counter() - g.pop("profile_started")) * 1000
+        try:
+            self.save(profile, request.url_rule.rule if request.url_rule else request.path, duration_ms)
+        except OSError as ex:
+            self.logging.log_debug(f"Class: Profiler | Method: after_request | ErorMsg: {ex}")
+        return response
+
+    def save(self, profile, route, duration_ms):
+        route_folder = re.sub(r"[^A-Za-z0-9_.-]+", "_", route).strip("_") or "root"
+        timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        profile_dir = os.path.join(self.profile_path, route_folder)
+        os.makedirs(profile_dir, exist_ok=True)
+
+        profile_file = os.path.join(profile_dir, f"{timestamp}.pstats")
+        profile.dump_stats(profile_file)
+
+        with self._lock:
+            with open(os.path.join(self.profile_path, "index.jsonl"), "a") as file:
+                file.write(json.dumps({
+                    "route": route,
+                    "method": request.method,
+                    "timestamp": timestamp,
+                    "duration_ms": round(duration_ms, 3),
+                    "file": os.path.relpath(profile_file, self.profile_path)
+                }) + "\n")
+            self.enforce_size_cap()
+
+    def enforce_size_cap(self):
+        profile_files = []
+        for directory, _, filenames in os.walk(self.profile_path):
+            for filename in filenames:
+                if filename.endswith(".pstats"):
+                    profile_file = os.path.join(directory, filename)
+                    profile_files.append((os.path.getmtime(profile_file), os.path.getsize(profile_file), profile_file))
+
+        total_bytes = sum(size for _, size, _ in profile_files)
+        removed = False
+        for _, size, profile_file in sorted(profile_files):
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(profile_file)
+            total_bytes -= size
+            removed = True
+
+        if removed:
+            # Drop index lines whose profile is gone so the index stays bounded too
+            index_file = os.path.join(self.profile_path, "index.jsonl")
+            with open(index_file, "r") as file:
+                lines = [
+                    line for line in file
+                    if os.path.exists(os.path.join(self.profile_path, json.loads(line)["file"]))
+                ]
+            with open(index_file, "w") as file:
+                file.writelines(lines)
\ No newline at end of file
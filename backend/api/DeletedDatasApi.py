@@ -1,18 +1,22 @@
 import base64
-from bson import ObjectId
-from flask import request, jsonify, Blueprint
+from flask import request, jsonify, Blueprint, g
+from api.Pagination import Pagination
+from api.Streaming import Streaming
 
 class DeletedDatasApi:
     
-    def __init__(self, name, logging, database) -> None:
+    def __init__(self, name, logging, database, auth) -> None:
         self.blueprint = Blueprint("deleted_data", name)
-        self.register_route()
         self.database = database
         self.logging = logging
+        self.auth = auth
+        self.streaming = Streaming(logging)
+        self.register_route()
         
     def register_route(self):
         
         @self.blueprint.route("/api/retrieve_all_deleted_datas/<user_id>", methods=["GET"])
+        @self.auth.require_user
         def api_retrieve_all_deleted_data(user_id):
             if request.method != "GET":
                 return jsonify({
@@ -21,19 +25,21 @@ class DeletedDatasApi:
                 }), 405
                 
             try:
-                # Decode the user id
-                decode_user_id = base64.urlsafe_b64decode(user_id).decode()
-                object_user_id = ObjectId(decode_user_id)
-                user_collection = self.database.database_connection("users")
-                user = user_collection.find_one({ "_id": object_user_id })
-                if not user:
+                try:
+                    pagination = Pagination(request.args)
+                except ValueError as ex:
                     return jsonify({
-                        "errorMsg": "Invalid ID.",
-                        "statusCode": 404
-                    })
+                        "errorMsg": str(ex),
+                        "statusCode": 400
+                    }), 400
                     
                 deleted_data_collection = self.database.database_connection("deleted_datas")
-                deleted_data_list = list(deleted_data_collection.find({}))
+                # Only the caller's deletions, only owners can delete so deleted_by is the owner
+                owner_query = { "deleted_by": g.user_id }
+                if self.streaming.wants_stream(request):
+                    return self.streaming.response(request, pagination.find_all(deleted_data_collection, owner_query), "Retrieve successful.")
+                    
+                deleted_data_list, next_cursor = pagination.page(list(pagination.find(deleted_data_collection, owner_query)))
                 # Convert return Object id to string
                 for deleted_data in deleted_data_list:
                     # Convert return Object id to string
@@ -44,6 +50,7 @@ class DeletedDatasApi:
                 return jsonify({
                     "successMsg": "Retrieve successful.",
                     "data": deleted_data_list,
+                    "nextCursor": next_cursor,
                     "statusCode": 200
                 }), 200
             
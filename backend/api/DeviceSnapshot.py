@@ -0,0 +1,101 @@
+import struct
+import threading
+from Cache import Cache
+
+class DeviceSnapshot:
+
+    """
+    * Precomputed compact lamp state for the board controllers, one snapshot per owner
+    * Holds only led, status, intensity and the RGB triple parsed from colour
+    * Rebuilt lazily on the first read after one of the owner's lamps changes (see invalidate)
+    *
+    * Binary frame (big-endian):
+    *   header  "LMP" | version (uint8) | count (uint16)
+    *   record  led (uint16) | status (uint8) | intensity (uint8) | red | green | blue (uint8)
+    * CSV: one "led,status,intensity,red,green,blue" line per lamp
+    """
+
+    frame_magic = b"LMP"
+    frame_version = 1
+    header_format = ">3sBH"
+    record_format = ">HBBBBB"
+
+    def __init__(self, logging, database, overlay=None, max_owners=1024) -> None:
+        self.logging = logging
+        self.database = database
+        # Applies write-behind state not yet in Mongo, see LampWriteBuffer.overlay
+        self.overlay = overlay
+        self._lock = threading.Lock()
+        # Owners whose lamps changed since their frames were built
+        self._dirty = set()
+        # owner -> frames, least recently polled owners are dropped first
+        self._frames = Cache(max_owners)
+
+    def invalidate(self, owner):
+        self._dirty.add(owner)
+
+    def get(self, owner, frame_format):
+        # While a rebuild runs, other readers keep serving the previous frames
+        # Only the first read for an owner has nothing to serve and waits for the lock
+        frames = self._frames.get(owner)
+        if frames is None or owner in self._dirty:
+            with self._lock:
+                # Only the first waiting thread rebuilds, the others reuse its result
+                frames = self._frames.get(owner)
+                if frames is None or owner in self._dirty:
+                    self._dirty.discard(owner)
+                    try:
+                        frames = self.build(owner)
+                    except Exception:
+                        self._dirty.add(owner)
+                        raise
+                    self._frames.set(owner, frames)
+        return frames[frame_format]
+
+    def build(self, owner):
+        lamp_collection = self.database.database_connection("lamps")
+        lamps = lamp_collection.find(
+            { "created_by": owner },
+            { "_id": 1 if self.overlay else 0, "led": 1, "status": 1, "intensity": 1, "colour": 1 }
+        ).sort("led", 1)
+
+        records = []
+        packed = []
+        for lamp in lamps:
+            if self.overlay:
+                lamp = self.overlay(lamp)
+            try:
+                record = (
+                    int(lamp["led"]),
+                    self.parse_status(lamp.get("status")),
+                    max(0, min(255, int(lamp.get("intensity") or 0))),
+                    *self.parse_colour(lamp.get("colour"))
+                )
+                # Packed here so a lamp that does not fit the frame (e.g. led above 65535) is skipped, not the whole snapshot
+                packed.append(struct.pack(self.record_format, *record))
+                records.append(record)
+            except (KeyError, TypeError, ValueError, struct.error) as ex:
+                self.logging.log_debug(f"Class: DeviceSnapshot | Method: build | Lamp: {lamp} | ErorMsg: {ex}")
+
+        binary = struct.pack(self.header_format, self.frame_magic, self.frame_version, len(records))
+        binary += b"".join(packed)
+        csv = "".join(",".join(str(value) for value in record) + "\n" for record in records)
+
+        return {
+            "bin": binary,
+            "csv": csv.encode()
+        }
+
+    @staticmethod
+    def parse_status(status):
+        if isinstance(status, str):
+            return 1 if status.strip().lower() in ("1", "on", "true") else 0
+        return 1 if status else 0
+
+    @staticmethod
+    def parse_colour(colour):
+        hex_code = (colour or "#000000").lstrip("#")
+        # Expand the short form, e.g. #f80 -> #ff8800
+        if len(hex_code) == 3:
+            hex_code = "".join(char * 2 for char in hex_code)
+        return int(hex_code[0:2], 16), int(hex_code[2:4], 16), int(hex_code[4:6], 16)
\ No newline at end of file
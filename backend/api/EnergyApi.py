@@ -0,0 +1,138 @@
+from datetime import datetime, timedelta, timezone
+from flask import request, jsonify, Blueprint, g
+from api.EnergyRollup import EnergyRollup
+
+class EnergyApi:
+
+    """
+    * Per lamp current and energy usage by hour, day or month, read from the rollups only (see EnergyRollup)
+    * Months are summed from the daily rollups, raw readings are never scanned and may already be expired
+    """
+
+    # Rollup period read for each requested period, and the default and longest time range
+    periods = {
+        "hour": ("hour", timedelta(days=1), timedelta(days=31)),
+        "day": ("day", timedelta(days=30), timedelta(days=366)),
+        "month": ("day", timedelta(days=365), timedelta(days=366 * 5))
+    }
+
+    def __init__(self, name, logging, database, auth, config, metrics=None) -> None:
+        self.blueprint = Blueprint("energy", name)
+        self.database = database
+        self.logging = logging
+        self.auth = auth
+        self.rollup = EnergyRollup(
+            logging,
+            database,
+            supply_voltage=config.telemetry.supply_voltage,
+            sample_interval_ms=config.telemetry.sample_interval_ms,
+            metrics=metrics
+        )
+        self.register_route()
+
+    def parse_time(self, name, default):
+        # ISO 8601, e.g. 2024-05-01 or 2024-05-01T12:00:00+02:00, naive values are UTC
+        value = request.args.get(name)
+        if value is None:
+            return default
+        try:
+            parsed = datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError(f"{name} must be an ISO 8601 date or time.")
+        if parsed.tzinfo is not None:
+            parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+        return parsed
+
+    def summarize(self, rollup):
+        return {
+            "led": rollup["led"],
+            "start": rollup["start"].isoformat(),
+            "count": rollup["count"],
+            "min_ma": rollup["min_ma"],
+            "max_ma": rollup["max_ma"],
+            "avg_ma": rollup["sum_ma"] / rollup["count"],
+            "wh": rollup["wh"]
+        }
+
+    def by_month(self, rollups):
+        # Sums the daily rollups into calendar months per led
+        months = {}
+        for rollup in rollups:
+            key = (rollup["led"], rollup["start"].replace(day=1))
+            month = months.get(key)
+            if month is None:
+                months[key] = dict(rollup, start=key[1])
+            else:
+                month["count"] += rollup["count"]
+                month["sum_ma"] += rollup["sum_ma"]
+                month["wh"] += rollup["wh"]
+                month["min_ma"] = min(month["min_ma"], rollup["min_ma"])
+                month["max_ma"] = max(month["max_ma"], rollup["max_ma"])
+        return sorted(months.values(), key=lambda month: (month["start"], month["led"]))
+
+    def register_route(self):
+
+        @self.blueprint.route("/api/energy/<user_id>", methods=["GET"])
+        @self.auth.require_user
+        def api_retrieve_energy(user_id):
+            # ?period=hour|day|month&from=<ISO>&to=<ISO>&led=<n>, every lamp of the user when led is not given
+            try:
+                period = request.args.get("period", "hour")
+                if period not in self.periods:
+                    return jsonify({
+                        "errorMsg": f"period must be one of {', '.join(self.periods)}.",
+                        "statusCode": 400
+                    }), 400
+                rollup_period, default_range, max_range = self.periods[period]
+
+                try:
+                    end = self.parse_time("to", datetime.now(timezone.utc).replace(tzinfo=None))
+                    start = self.parse_time("from", end - default_range)
+                except ValueError as ex:
+                    return jsonify({
+                        "errorMsg": str(ex),
+                        "statusCode": 400
+                    }), 400
+
+                if start >= end or end - start > max_range:
+                    return jsonify({
+                        "errorMsg": f"from must be before to and at most {max_range.days} days earlier.",
+                        "statusCode": 400
+                    }), 400
+
+                # Widen from to the start of its bucket, so a partial first bucket is included
+                collection_name, bucket_start = EnergyRollup.periods[rollup_period]
+                start = bucket_start(start)
+                if period == "month":
+                    start = start.replace(day=1)
+
+                query = { "user": g.user_id, "start": { "$gte": start, "$lt": end } }
+                if "led" in request.args:
+                    try:
+                        query["led"] = int(request.args["led"])
+                    except ValueError:
+                        return jsonify({
+                            "errorMsg": "led must be a number.",
+                            "statusCode": 400
+                        }), 400
+
+                rollup_collection = self.database.database_connection(collection_name)
+                rollups = list(rollup_collection.find(query, { "_id": 0, "updated_at": 0 }).sort([("start", 1), ("led", 1)]))
+                if period == "month":
+                    rollups = self.by_month(rollups)
+
+                return jsonify({
+                    "successMsg": "Retrieve successful.",
+                    "data": [self.summarize(rollup) for rollup in rollups],
+                    "period": period,
+                    "from": start.isoformat(),
+                    "to": end.isoformat(),
+                    "statusCode": 200
+                }), 200
+
+            except Exception as ex:
+                self.logging.log_debug(str(ex))
+                return jsonify({
+                    "errorMsg": str(ex),
+                    "statusCode": 500
+                }), 500
@@ -0,0 +1,82 @@
+from datetime import datetime, timezone
+from pymongo import UpdateOne
+from Metrics import Timer
+
+class EnergyRollup:
+
+    """
+    * Keeps hourly and daily current/energy aggregates per lamp (user, led) up to date as readings are written
+    * Used as the TelemetryBuffer on_flush callback, so each written batch is folded in with one bulk_write per period
+    * Aggregates are additive ($inc count, sum_ma, wh and $min/$max), so batches can arrive in any order
+    * Each reading counts as sample_interval_ms of draw at supply_voltage for the watt-hours
+    """
+
+    # Rollup collection and bucket start for each period
+    periods = {
+        "hour": ("lamp_energy_hourly", lambda ts: ts.replace(minute=0, second=0, microsecond=0)),
+        "day": ("lamp_energy_daily", lambda ts: ts.replace(hour=0, minute=0, second=0, microsecond=0))
+    }
+
+    def __init__(self, logging, database, supply_voltage=5.0, sample_interval_ms=1000, metrics=None) -> None:
+        self.logging = logging
+        self.database = database
+        # Watt-hours of one reading per milliampere
+        self.wh_per_ma = supply_voltage / 1000 * sample_interval_ms / 3600000
+
+        self.failed = None
+        self.apply_durations = None
+        if metrics is not None:
+            self.failed = metrics.counter("energy_rollup_readings_failed_total", "Readings whose rollup update failed.", ("period",))
+            self.apply_durations = metrics.histogram("energy_rollup_apply_duration_seconds", "Rollup bulk_write time per telemetry batch in seconds.", ("period",))
+
+    def buckets(self, readings, bucket_start):
+        # (user, led, start) -> partial aggregate of the readings in that bucket
+        buckets = {}
+        for reading in readings:
+            ts = reading["ts"]
+            if ts.tzinfo is not None:
+                ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+            key = (reading["meta"]["user"], reading["meta"]["led"], bucket_start(ts))
+            current_ma = reading["current_ma"]
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = { "count": 1, "sum_ma": current_ma, "min_ma": current_ma, "max_ma": current_ma }
+            else:
+                bucket["count"] += 1
+                bucket["sum_ma"] += current_ma
+                bucket["min_ma"] = min(bucket["min_ma"], current_ma)
+                bucket["max_ma"] = max(bucket["max_ma"], current_ma)
+        return buckets
+
+    def operations(self, buckets, updated_at):
+        return [
+            UpdateOne(
+                { "user": user, "led": led, "start": start },
+                {
+                    "$inc": { "count": bucket["count"], "sum_ma": bucket["sum_ma"], "wh": bucket["sum_ma"] * self.wh_per_ma },
+                    "$min": { "min_ma": bucket["min_ma"] },
+                    "$max": { "max_ma": bucket["max_ma"] },
+                    "$set": { "updated_at": updated_at }
+                },
+                upsert=True
+            )
+            for (user, led, start), bucket in buckets.items()
+        ]
+
+    def apply(self, readings):
+        # Runs on the telemetry writer thread, errors are logged and never raised
+        updated_at = datetime.now().isoformat()
+        for period, (collection_name, bucket_start) in self.periods.items():
+            try:
+                operations = self.operations(self.buckets(readings, bucket_start), updated_at)
+                rollup_collection = self.database.database_connection(collection_name)
+                if self.apply_durations is not None:
+                    with Timer(self.apply_durations, (("period", period),)):
+                        rollup_collection.bulk_write(operations, ordered=False)
+                else:
+                    rollup_collection.bulk_write(operations, ordered=False)
+            except Exception as ex:
+                # PyMongoError or e.g. a bson encoding error, the raw readings are stored and only this batch is missing from the rollup
+                self.logging.log_debug(f"Class: EnergyRollup | Method: apply | Period: {period} | Readings: {len(readings)} | ErorMsg: {ex}")
+                if self.failed is not None:
+                    self.failed.inc((("period", period),), len(readings))
@@ -1,27 +1,228 @@
-import qrcode
+import os
+import math
 import base64
 import re
 import uuid
-import os, yaml
-from flask import request, jsonify, Blueprint
+import json
+import threading
+from flask import request, jsonify, Blueprint, Response, g
 from datetime import datetime
 from bson import ObjectId
+from pymongo import UpdateOne, UpdateMany
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from api.Pagination import Pagination
+from api.Streaming import Streaming
+from api.DeviceSnapshot import DeviceSnapshot
+from api.QrImageCache import QrImageCache
+from api.LampWriteBuffer import LampWriteBuffer
+from api.LampCache import LampCache
 
 class LampApi:
     
-    def __init__(self, name, logging, database) -> None:
+    # Regular expression to match hex colour code entered by user
+    hex_pattern = re.compile(r"^#([a-f0-9]{6}|[a-f0-9]{3})$", re.IGNORECASE)
+    
+    # Fields a client may change and filter on in the bulk update endpoint
+    patch_fields = ["status", "intensity", "colour"]
+    filter_fields = ["led", "status", "intensity", "colour"]
+    filter_value_types = (str, int, float, bool, type(None))
+    max_batch_size = 1000
+    
+    # Board frames carry the led as uint16, see DeviceSnapshot
+    max_led = 65535
+    # The board scales colours by intensity percent, status also comes as text from older clients
+    max_intensity = 100
+    status_texts = ("0", "1", "on", "off", "true", "false")
+    status_error = "Status must be 0 or 1 (or on/off, true/false)."
+    intensity_error = f"Intensity must be a number from 0 to {max_intensity}."
+    
+    # Long-poll bounds in seconds for the change notification endpoints
+    default_wait_timeout = 25
+    max_wait_timeout = 60
+    # Seconds a client is asked to back off when every waiter slot is taken
+    busy_retry_after = 5
+    
+    def __init__(self, name, logging, database, auth, events, config, metrics=None) -> None:
         self.blueprint = Blueprint("lamp", name)
-        self.register_route()
         self.database = database
         self.logging = logging
+        self.auth = auth
+        self.streaming = Streaming(logging)
+        self.events = events
+        
+        # Long-poll and SSE requests each hold a worker thread, at most max_waiters at once (0 is no limit)
+        self.waiters = threading.BoundedSemaphore(config.lamps.max_waiters) if config.lamps.max_waiters else None
+        self.waiters_rejected = None
+        if metrics is not None:
+            self.waiters_rejected = metrics.counter("lamp_waiters_rejected_total", "Long-poll and SSE requests answered 503 because every waiter slot was taken.")
+        
+        # Lamp documents and list responses, invalidated by publish_change
+        self.lamp_cache = LampCache(
+            max_size=config.lamps.cache_size,
+            list_max_size=config.lamps.list_cache_size,
+            ttl=config.lamps.cache_ttl
+        )
+        
+        # Optional write-behind for single lamp updates, see LampWriteBuffer
+        self.write_buffer = None
+        if config.lamps.write_behind:
+            self.write_buffer = LampWriteBuffer(
+                logging,
+                database,
+                interval_ms=config.lamps.write_behind_interval_ms,
+                max_batch=config.lamps.write_behind_max_batch,
+                on_flush=self.lamp_cache.invalidate,
+                metrics=metrics
+            )
+            
+        # Invalidated per owner by publish_change
+        self.device_snapshot = DeviceSnapshot(logging, database, overlay=self.write_buffer.overlay if self.write_buffer else None)
+        
+        self.images_path = config.images.base
+        self.qr_images = QrImageCache(logging, self.images_path, max_size=config.images.qr_cache_size, metrics=metrics)
+        
+        self.register_route()
+        
+    def close(self):
+        # Writes pending write-behind updates, call on shutdown
+        if self.write_buffer:
+            self.write_buffer.close()
+            
+    def encode_lamp(self, lamp):
+        # Streaming encoder that also applies pending write-behind fields
+        return self.streaming.encode_id(self.write_buffer.overlay(lamp))
+        
+    @staticmethod
+    def topic(owner):
+        # Each owner only waits for and receives changes of their own lamps
+        return f"lamps:{owner}"
+        
+    def remove_qr_images(self, lamp):
+        # The rendered image of a deleted lamp is never served again
+        if self.qr_images.is_valid(str(lamp.get("qr_id", ""))):
+            self.qr_images.discard(lamp["qr_id"])
+            
+        # Lamps created before on-demand rendering still point to a PNG written at creation
+        qr_image_path = lamp.get("qr_image_path")
+        if not qr_image_path:
+            return
+        images_path = os.path.realpath(self.images_path)
+        qr_image_path = os.path.realpath(qr_image_path)
+        if os.path.dirname(qr_image_path) != images_path:
+            self.logging.log_debug(f"Class: LampApi | Method: remove_qr_images | Skipped: {qr_image_path}")
+            return
+        try:
+            os.remove(qr_image_path)
+        except FileNotFoundError:
+            pass
+        except OSError as ex:
+            self.logging.log_debug(f"Class: LampApi | Method: remove_qr_images | ErorMsg: {ex}")
+            
+    def publish_change(self, change, owner, object_lamp_id, led):
+        # Called right after every lamp write, so cached copies never outlive the write
+        self.lamp_cache.invalidate(owner, object_lamp_id)
+        self.device_snapshot.invalidate(owner)
+        self.events.publish(self.topic(owner), {
+            "change": change,
+            "lamp_id": base64.urlsafe_b64encode(str(object_lamp_id).encode()).decode(),
+            "led": led
+        })
+        
+    def parse_if_match(self):
+        # If-Match carries the lamp version from the ETag, e.g. "12" (W/"12" is accepted too)
+        header = request.headers.get("If-Match")
+        if not header:
+            return None
+        return int(header.strip().removeprefix("W/").strip('"'))
+        
+    @staticmethod
+    def etag(version):
+        # Lamps written before versioning have no version field, they count as 0
+        return f'"{version or 0}"'
+        
+    def parse_wait_args(self):
+        # Event ids count EventBus events in this process (they restart at 0), they are not lamp versions:
+        # lastEventId defaults to the latest event, i.e. wait for the next change
+        # Raises ValueError for anything that is not a number, the routes answer 400
+        last_event_id = int(request.args.get("lastEventId", self.events.version))
+        timeout = float(request.args.get("timeout", self.default_wait_timeout))
+        if not math.isfinite(timeout):
+            raise ValueError("timeout must be finite")
+        return last_event_id, max(min(timeout, self.max_wait_timeout), 0)
+        
+    def acquire_waiter(self):
+        # Never blocks: False when max_waiters requests are already waiting, the caller answers 503
+        if self.waiters is None or self.waiters.acquire(blocking=False):
+            return True
+        if self.waiters_rejected is not None:
+            self.waiters_rejected.inc()
+        return False
+        
+    def release_waiter(self):
+        if self.waiters is not None:
+            self.waiters.release()
+            
+    def busy_response(self):
+        response = jsonify({
+            "errorMsg": "Too many clients are waiting for changes, try again later.",
+            "statusCode": 503
+        })
+        response.headers["Retry-After"] = str(self.busy_retry_after)
+        return response, 503
+        
+    def valid_led(self, led):
+        return isinstance(led, int) and not isinstance(led, bool) and 0 <= led <= self.max_led
+        
+    def valid_status(self, status):
+        if isinstance(status, bool):
+            return True
+        if isinstance(status, int):
+            return status in (0, 1)
+        return isinstance(status, str) and status.strip().lower() in self.status_texts
         
-        with open(os.path.join("PATH_TO_YAML_FILE", "paths.yaml"), "r") as file:
-            content = yaml.safe_load(file)
-        self.images_path = content["images"]["base"]
+    def valid_intensity(self, intensity):
+        return isinstance(intensity, (int, float)) and not isinstance(intensity, bool) and 0 <= intensity <= self.max_intensity
+        
+    def validate_patch(self, patch):
+        # Returns the $set fields for a patch, raises ValueError when it is invalid
+        if not isinstance(patch, dict) or not any(key in patch for key in self.patch_fields):
+            raise ValueError(f"At least one of {', '.join(self.patch_fields)} is required.")
+            
+        if "status" in patch and not self.valid_status(patch["status"]):
+            raise ValueError(self.status_error)
+            
+        if "intensity" in patch and not self.valid_intensity(patch["intensity"]):
+            raise ValueError(self.intensity_error)
+            
+        if "colour" in patch and not (isinstance(patch["colour"], str) and self.hex_pattern.match(patch["colour"])):
+            raise ValueError("Invalid hex code.")
+            
+        return { key: patch[key] for key in self.patch_fields if key in patch }
+        
+    def validate_filter(self, lamp_filter):
+        if not isinstance(lamp_filter, dict) or not lamp_filter:
+            raise ValueError("Filter must be a non-empty object.")
+            
+        unknown_keys = [key for key in lamp_filter if key not in self.filter_fields]
+        if unknown_keys:
+            raise ValueError(f"Unknown filter fields: {', '.join(unknown_keys)}.")
+            
+        # Plain values only, an object such as { "$gt": 0 } would reach Mongo as a query operator
+        for key, value in lamp_filter.items():
+            values = value if isinstance(value, list) else [value]
+            if not all(isinstance(item, self.filter_value_types) for item in values):
+                raise ValueError(f"Filter field {key} must be a value or a list of values.")
+                
+        # A list value matches any of its items
+        return {
+            key: { "$in": value } if isinstance(value, list) else value
+            for key, value in lamp_filter.items()
+        }
         
     def register_route(self):
         
         @self.blueprint.route("/api/create_lamp/<user_id>", methods=["POST"])
+        @self.auth.require_user
         def api_create_lamp(user_id):
             if request.method != "POST":
                 return jsonify({
@@ -36,17 +237,8 @@ class LampApi:
                 })
                 
             try:
-                # Decode the user id
-                decode_user_id = base64.urlsafe_b64decode(user_id).decode()
-                object_user_id = ObjectId(decode_user_id)
-                user_collection = self.database.database_connection("users")
-                user = user_collection.find_one({ "_id": object_user_id })
-                if not user:
-                    return jsonify({
-                        "errorMsg": "Invalid ID.",
-                        "statusCode": 404
-                    })
-                                    
+                decode_user_id = g.user_id
+                
                 request_data = request.get_json()
                 required_keys = [
                     "led",
@@ -69,11 +261,26 @@ class LampApi:
                 intensity = request_data["intensity"]
                 colour = request_data["colour"]
                 
-                # Regular expression to match hex colour code entered by user
-                hex_pattern = re.compile(r"^#([a-f0-9]{6}|[a-f0-9]{3})$", re.IGNORECASE)
-                
+                if not self.valid_led(led):
+                    return jsonify({
+                        "errorMsg": f"LED must be a number from 0 to {self.max_led}.",
+                        "statusCode": 400
+                    }), 400
+                    
+                if not self.valid_status(status):
+                    return jsonify({
+                        "errorMsg": self.status_error,
+                        "statusCode": 400
+                    }), 400
+                    
+                if not self.valid_intensity(intensity):
+                    return jsonify({
+                        "errorMsg": self.intensity_error,
+                        "statusCode": 400
+                    }), 400
+                    
                 # Check if the hex code entered by user is valid format
-                if not hex_pattern.match(request_data["colour"]):
+                if not isinstance(request_data["colour"], str) or not self.hex_pattern.match(request_data["colour"]):
                     return jsonify({
                         "errorMsg": "Invalid hex code.",
                         "statusCode": 400
@@ -85,39 +292,153 @@ class LampApi:
                 created_by = decode_user_id
                 updated_by = decode_user_id
                 
-                # Create id for qr code
+                # Create id for qr code, the image is rendered on demand by api_lamp_qr
                 qr_code_id = uuid.uuid4().hex
-                # Generate qr code image
-                qr_code_image_generator = qrcode.make(qr_code_id)
-                image_filename = f"LampQR_{qr_code_id}.png"
-                qr_image_path = os.path.join(self.images_path, image_filename)
-                # Save image to desire path
-                qr_code_image_generator.save(qr_image_path)
                 
                 lamp_collection = self.database.database_connection("lamps")
-                # Check if led is exists
-                lamp = lamp_collection.find_one({ "led": led }, { "_id": 0 })
-                if lamp:
+                # The unique (created_by, led) index rejects LEDs this user already registered
+                try:
+                    with self.database.next_version(decode_user_id) as version:
+                        result = lamp_collection.insert_one({
+                            "led": led,
+                            "status": status,
+                            "intensity": intensity,
+                            "colour": colour,
+                            "qr_id": qr_code_id,
+                            "created_by": created_by,
+                            "updated_by": updated_by,
+                            "created_at": created_at,
+                            "updated_at": updated_at,
+                            "version": version
+                        })
+                except DuplicateKeyError:
                     return jsonify({
                         "errorMsg": "LED has been registered. Please enter another number.",
                         "statusCode": 409
                     }), 409
+                self.publish_change("created", created_by, result.inserted_id, led)
+                
+                return jsonify({
+                    "successMsg": "Create successful.",
+                    "qrImageUrl": f"/api/lamp_qr/{qr_code_id}",
+                    "statusCode": 200
+                }), 200
+                
+            except Exception as ex:
+                self.logging.log_debug(str(ex))
+                return jsonify({
+                    "errorMsg": str(ex),
+                    "statusCode": 500
+                }), 500
+            
+            
+        @self.blueprint.route("/api/create_lamps/<user_id>", methods=["POST"])
+        @self.auth.require_user
+        def api_create_lamps(user_id):
+            # Body is {"lamps": [{"led", "status", "intensity", "colour"}, ...]}
+            try:
+                decode_user_id = g.user_id
+                
+                request_data = request.get_json()
+                items = request_data.get("lamps") if isinstance(request_data, dict) else None
+                if not isinstance(items, list) or not items or len(items) > self.max_batch_size:
+                    return jsonify({
+                        "errorMsg": f"lamps must be a list of 1 to {self.max_batch_size} items.",
+                        "statusCode": 400
+                    }), 400
                     
-                lamp_collection.insert_one({
-                    "led": led,
-                    "status": status,
-                    "intensity": intensity,
-                    "colour": colour,
-                    "qr_id": qr_code_id,
-                    "qr_image_path": qr_image_path,
-                    "created_by": created_by,
-                    "updated_by": updated_by,
-                    "created_at": created_at,
-                    "updated_at": updated_at
-                })
+                required_keys = [
+                    "led",
+                    "status",
+                    "intensity",
+                    "colour"
+                ]
+                lamp_collection = self.database.database_connection("lamps")
                 
+                # Duplicates are checked up front so nothing is written for a rejected lamp
+                requested_leds = [item["led"] for item in items if isinstance(item, dict) and "led" in item]
+                registered_leds = {
+                    lamp["led"] for lamp in lamp_collection.find({ "created_by": decode_user_id, "led": { "$in": requested_leds } }, { "_id": 0, "led": 1 })
+                }
+                
+                created_at = datetime.now().isoformat()
+                results = []
+                documents = []
+                seen_leds = set()
+                for item in items:
+                    missing_keys = [key for key in required_keys if not isinstance(item, dict) or key not in item]
+                    if missing_keys:
+                        results.append({ "led": item.get("led") if isinstance(item, dict) else None, "errorMsg": "Bad Request - Missing Parameters", "missingParameters": missing_keys, "statusCode": 400 })
+                        continue
+                    if not self.valid_led(item["led"]):
+                        results.append({ "led": item["led"], "errorMsg": f"LED must be a number from 0 to {self.max_led}.", "statusCode": 400 })
+                        continue
+                    if not self.valid_status(item["status"]):
+                        results.append({ "led": item["led"], "errorMsg": self.status_error, "statusCode": 400 })
+                        continue
+                    if not self.valid_intensity(item["intensity"]):
+                        results.append({ "led": item["led"], "errorMsg": self.intensity_error, "statusCode": 400 })
+                        continue
+                    if not isinstance(item["colour"], str) or not self.hex_pattern.match(item["colour"]):
+                        results.append({ "led": item["led"], "errorMsg": "Invalid hex code.", "statusCode": 400 })
+                        continue
+                    if item["led"] in registered_leds or item["led"] in seen_leds:
+                        results.append({ "led": item["led"], "errorMsg": "LED has been registered. Please enter another number.", "statusCode": 409 })
+                        continue
+                        
+                    seen_leds.add(item["led"])
+                    qr_code_id = uuid.uuid4().hex
+                    documents.append({
+                        "led": item["led"],
+                        "status": item["status"],
+                        "intensity": item["intensity"],
+                        "colour": item["colour"],
+                        "qr_id": qr_code_id,
+                        "created_by": decode_user_id,
+                        "updated_by": decode_user_id,
+                        "created_at": created_at,
+                        "updated_at": created_at
+                    })
+                    results.append({ "led": item["led"], "index": len(documents) - 1 })
+                    
+                # Unordered, so a lamp registered concurrently only fails its own item
+                failed = {}
+                if documents:
+                    # One version for the whole batch
+                    with self.database.next_version(decode_user_id) as version:
+                        for document in documents:
+                            document["version"] = version
+                        try:
+                            lamp_collection.insert_many(documents, ordered=False)
+                        except BulkWriteError as ex:
+                            for error in ex.details.get("writeErrors", []):
+                                failed[error["index"]] = error
+                            
+                inserted = [document for index, document in enumerate(documents) if index not in failed]
+                    
+                for result in results:
+                    index = result.pop("index", None)
+                    if index is None:
+                        continue
+                    document = documents[index]
+                    error = failed.get(index)
+                    if error is None:
+                        result["lampId"] = base64.urlsafe_b64encode(str(document["_id"]).encode()).decode()
+                        result["qrImageUrl"] = f"/api/lamp_qr/{document['qr_id']}"
+                        result["statusCode"] = 200
+                    elif error.get("code") == 11000:
+                        result["errorMsg"] = "LED has been registered. Please enter another number."
+                        result["statusCode"] = 409
+                    else:
+                        result["errorMsg"] = error.get("errmsg")
+                        result["statusCode"] = 500
+                        
+                for document in inserted:
+                    self.publish_change("created", decode_user_id, document["_id"], document["led"])
+                    
                 return jsonify({
                     "successMsg": "Create successful.",
+                    "data": results,
                     "statusCode": 200
                 }), 200
                 
@@ -130,6 +451,7 @@ class LampApi:
             
             
         @self.blueprint.route("/api/retrieve_all_lamps/<user_id>", methods=["GET"])
+        @self.auth.require_user
         def api_retrieve_all_lamps(user_id):
             if request.method != "GET":
                 return jsonify({
@@ -138,31 +460,45 @@ class LampApi:
                 }), 405
                 
             try:
-                # Decode the user id
-                decode_user_id = base64.urlsafe_b64decode(user_id).decode()
-                object_user_id = ObjectId(decode_user_id)
-                user_collection = self.database.database_connection("users")
-                user = user_collection.find_one({ "_id": object_user_id })
-                if not user:
+                try:
+                    pagination = Pagination(request.args, sort_fields=("_id", "updated_at"))
+                except ValueError as ex:
                     return jsonify({
-                        "errorMsg": "Invalid ID.",
-                        "statusCode": 404
-                    })
+                        "errorMsg": str(ex),
+                        "statusCode": 400
+                    }), 400
                     
                 lamp_collection = self.database.database_connection("lamps")
-                lamp_list = list(lamp_collection.find({}))
+                # Only the caller's lamps, served by the created_by compound indexes
+                owner_query = { "created_by": g.user_id }
+                if self.streaming.wants_stream(request):
+                    encode = self.encode_lamp if self.write_buffer else None
+                    return self.streaming.response(request, pagination.find_all(lamp_collection, owner_query), "Retrieve successful.", encode)
+                    
+                # Serialized page from an earlier identical request
+                body = self.lamp_cache.get_list(g.user_id, request.query_string)
+                if body is not None:
+                    return Response(body, status=200, mimetype="application/json")
+                    
+                generation = self.lamp_cache.generation
+                lamp_list, next_cursor = pagination.page(list(pagination.find(lamp_collection, owner_query)))
                 # Convert return Object id to string
                 for lamp in lamp_list:
+                    if self.write_buffer:
+                        self.write_buffer.overlay(lamp)
                     # Convert return Object id to string
                     lamp["_id"] = str(lamp["_id"])
                     # Convert object id to random string byte (after encoding it to bytes first)
                     lamp["_id"] = base64.urlsafe_b64encode(lamp["_id"].encode()).decode()
                     
-                return jsonify({
+                response = jsonify({
                     "successMsg": "Retrieve successful.",
                     "data": lamp_list,
+                    "nextCursor": next_cursor,
                     "statusCode": 200
-                }), 200
+                })
+                self.lamp_cache.set_list(g.user_id, request.query_string, response.get_data(), generation)
+                return response, 200
             
             except Exception as ex:
                 self.logging.log_debug(str(ex))
@@ -175,6 +511,7 @@ class LampApi:
                 
                 
         @self.blueprint.route("/api/retrieve_lamp/<user_id>/<lamp_id>", methods=["GET"])
+        @self.auth.require_user
         def api_retrieve_lamp(user_id, lamp_id):
             if request.method != "GET":
                 return jsonify({
@@ -183,28 +520,28 @@ class LampApi:
                 }), 405
                 
             try:
-                # Decode the user id
-                decode_user_id = base64.urlsafe_b64decode(user_id).decode()
-                object_user_id = ObjectId(decode_user_id)
-                user_collection = self.database.database_connection("users")
-                user = user_collection.find_one({ "_id": object_user_id })
-                if not user:
-                    return jsonify({
-                        "errorMsg": "Invalid ID.",
-                        "statusCode": 404
-                    })
-                    
                 # Decode the user id
                 decode_lamp_id = base64.urlsafe_b64decode(lamp_id).decode()
                 object_lamp_id = ObjectId(decode_lamp_id)
                 lamp_collection = self.database.database_connection("lamps")
-                lamp = lamp_collection.find_one({ "_id": object_lamp_id })
+                # The ETag has to be the version of the body, so a pending write-behind update is written first
+                if self.write_buffer and self.write_buffer.pending(object_lamp_id):
+                    self.write_buffer.flush()
+                lamp = self.lamp_cache.get_lamp(lamp_collection, object_lamp_id)
                 
-                if not lamp:
+                # Another user's lamp is reported as missing
+                if not lamp or lamp.get("created_by") != g.user_id:
                     return jsonify({
                         "errorMsg": "Lamp not found.",
                         "statusCode": 404
                     }), 404
+                    
+                # Sent back in If-Match when updating this lamp, left out while the flush above failed
+                # (or a newer update arrived), the body then is not the stored version
+                headers = { "ETag": self.etag(lamp.get("version")) }
+                if self.write_buffer and self.write_buffer.pending(object_lamp_id):
+                    self.write_buffer.overlay(lamp)
+                    headers = {}
                 
                 # Convert return Object id to string
                 lamp["_id"] = str(lamp["_id"])
@@ -213,7 +550,7 @@ class LampApi:
                     "successMsg": "Retrieve successful.",
                     "data": lamp,
                     "statusCode": 200
-                }), 200
+                }), 200, headers
             
             except Exception as ex:
                 self.logging.log_debug(str(ex))
@@ -225,6 +562,7 @@ class LampApi:
                 
                 
         @self.blueprint.route("/api/update_lamp/<user_id>/<lamp_id>", methods=["PUT"])
+        @self.auth.require_user
         def api_update_lamp(user_id, lamp_id):
             if request.method != "PUT":
                 return jsonify({
@@ -239,30 +577,31 @@ class LampApi:
                 })
                 
             try:
-                # Decode the user id
-                decode_user_id = base64.urlsafe_b64decode(user_id).decode()
-                object_user_id = ObjectId(decode_user_id)
-                user_collection = self.database.database_connection("users")
-                # Find user in database
-                user = user_collection.find_one({ "_id": object_user_id })
-                if not user:
+                decode_user_id = g.user_id
+                
+                try:
+                    expected_version = self.parse_if_match()
+                except ValueError:
                     return jsonify({
-                        "errorMsg": "Invalid ID.",
-                        "statusCode": 404
-                    })
+                        "errorMsg": "If-Match must be a lamp version.",
+                        "statusCode": 400
+                    }), 400
                     
                 # Decode the lamp id
                 decode_lamp_id = base64.urlsafe_b64decode(lamp_id).decode()
                 object_lamp_id = ObjectId(decode_lamp_id)
                 lamp_collection = self.database.database_connection("lamps")
-                # Find lamp in database
-                lamp = lamp_collection.find_one({ "_id": object_lamp_id })
-                
-                if not lamp:
-                    return jsonify({
-                        "errorMsg": "Lamp not found.",
-                        "statusCode": 404
-                    }), 404
+                # Find lamp in database, a lamp with a pending write-behind update is known to exist
+                led = self.write_buffer.led(object_lamp_id, decode_user_id) if self.write_buffer else None
+                if led is None:
+                    lamp = self.lamp_cache.get_lamp(lamp_collection, object_lamp_id)
+                    
+                    if not lamp or lamp.get("created_by") != decode_user_id:
+                        return jsonify({
+                            "errorMsg": "Lamp not found.",
+                            "statusCode": 404
+                        }), 404
+                    led = lamp["led"]
                     
                 request_data = request.get_json()
                 required_keys = [
@@ -282,17 +621,27 @@ class LampApi:
                 update_fields = {}  # Create a dictionary for dynamic update query
                 
                 if "status" in request_data:
+                    if not self.valid_status(request_data["status"]):
+                        return jsonify({
+                            "errorMsg": self.status_error,
+                            "statusCode": 400
+                        }), 400
+                        
                     update_fields["status"] = request_data["status"]
                 
                 if "intensity" in request_data:
+                    # Checked before the write-behind buffer takes it, a value bson cannot encode would be dropped there
+                    if not self.valid_intensity(request_data["intensity"]):
+                        return jsonify({
+                            "errorMsg": self.intensity_error,
+                            "statusCode": 400
+                        }), 400
+                        
                     update_fields["intensity"] = request_data["intensity"]
                     
                 if "colour" in request_data:
-                    # Regular expression to match hex colour code entered by user
-                    hex_pattern = re.compile(r"^#([a-f0-9]{6}|[a-f0-9]{3})$", re.IGNORECASE)
-                    
                     # Check if the hex code entered by user is valid format
-                    if not hex_pattern.match(request_data["colour"]):
+                    if not isinstance(request_data["colour"], str) or not self.hex_pattern.match(request_data["colour"]):
                         return jsonify({
                             "errorMsg": "Invalid hex code.",
                             "statusCode": 400
@@ -307,13 +656,171 @@ class LampApi:
                 update_fields["updated_at"] = updated_at
                 update_fields["updated_by"] = updated_by
                                         
-                lamp_collection.update_one(
-                    { "_id": object_lamp_id },
-                    { "$set": update_fields }
-                )
+                version = None
+                if self.write_buffer and expected_version is None:
+                    # Merged with other pending updates of this lamp, the flush gives it a version
+                    self.write_buffer.add(object_lamp_id, decode_user_id, led, update_fields)
+                else:
+                    if self.write_buffer:
+                        # If-Match compares against Mongo, so pending updates go first
+                        self.write_buffer.flush()
+                        
+                    query = { "_id": object_lamp_id, "created_by": decode_user_id }
+                    if expected_version is not None:
+                        # Optimistic concurrency: only write over the version the client has seen
+                        query["version"] = expected_version or None
+                        
+                    with self.database.next_version(decode_user_id) as version:
+                        update_fields["version"] = version
+                        result = lamp_collection.update_one(query, { "$set": update_fields })
+                    if result.matched_count == 0:
+                        current = lamp_collection.find_one({ "_id": object_lamp_id, "created_by": decode_user_id }, { "version": 1 })
+                        if not current:
+                            return jsonify({
+                                "errorMsg": "Lamp not found.",
+                                "statusCode": 404
+                            }), 404
+                        return jsonify({
+                            "errorMsg": "Lamp was changed by another request. Retrieve it and try again.",
+                            "version": current.get("version", 0),
+                            "statusCode": 412
+                        }), 412, { "ETag": self.etag(current.get("version")) }
+                        
+                self.publish_change("updated", decode_user_id, object_lamp_id, led)
                 
+                response = jsonify({
+                    "successMsg": "Update successful.",
+                    "version": version,
+                    "statusCode": 200
+                })
+                if version is not None:
+                    response.headers["ETag"] = self.etag(version)
+                return response, 200
+                
+            except Exception as ex:
+                self.logging.log_debug(str(ex))
+                return jsonify({
+                    "errorMsg": str(ex),
+                    "statusCode": 500
+                }), 500
+                
+                
+        @self.blueprint.route("/api/update_lamps/<user_id>", methods=["PUT"])
+        @self.auth.require_user
+        def api_update_lamps(user_id):
+            # Body is either {"lamps": [{"lamp_id", "status", "intensity", "colour"}, ...]}
+            # or {"filter": {...}, "patch": {...}}, applied with a single bulk_write
+            try:
+                decode_user_id = g.user_id
+                
+                request_data = request.get_json()
+                if not isinstance(request_data, dict) or ("lamps" in request_data) == ("filter" in request_data):
+                    return jsonify({
+                        "errorMsg": "Provide either lamps or filter and patch.",
+                        "statusCode": 400
+                    }), 400
+                    
+                updated_at = datetime.now().isoformat()
+                updated_by = decode_user_id
+                lamp_collection = self.database.database_connection("lamps")
+                
+                # Pending single updates are older than this request, write them first
+                if self.write_buffer:
+                    self.write_buffer.flush()
+                
+                if "filter" in request_data:
+                    try:
+                        query = { **self.validate_filter(request_data["filter"]), "created_by": decode_user_id }
+                        update_fields = self.validate_patch(request_data.get("patch"))
+                    except ValueError as ex:
+                        return jsonify({
+                            "errorMsg": str(ex),
+                            "statusCode": 400
+                        }), 400
+                        
+                    update_fields["updated_at"] = updated_at
+                    update_fields["updated_by"] = updated_by
+                    
+                    # Matched lamps are read first so every change can be published
+                    lamps = list(lamp_collection.find(query, { "_id": 1, "led": 1 }))
+                    if lamps:
+                        with self.database.next_version(decode_user_id) as version:
+                            update_fields["version"] = version
+                            lamp_collection.bulk_write([
+                                UpdateMany({ "_id": { "$in": [lamp["_id"] for lamp in lamps] } }, { "$set": update_fields })
+                            ])
+                    for lamp in lamps:
+                        self.publish_change("updated", decode_user_id, lamp["_id"], lamp["led"])
+                        
+                    return jsonify({
+                        "successMsg": "Update successful.",
+                        "matchedCount": len(lamps),
+                        "statusCode": 200
+                    }), 200
+                    
+                items = request_data["lamps"]
+                if not isinstance(items, list) or not items or len(items) > self.max_batch_size:
+                    return jsonify({
+                        "errorMsg": f"lamps must be a list of 1 to {self.max_batch_size} items.",
+                        "statusCode": 400
+                    }), 400
+                    
+                # Validate the whole batch before touching the database
+                results = []
+                updates = {}
+                for item in items:
+                    lamp_id = item.get("lamp_id") if isinstance(item, dict) else None
+                    try:
+                        object_lamp_id = ObjectId(base64.urlsafe_b64decode(lamp_id).decode())
+                    except Exception:
+                        results.append({ "lampId": lamp_id, "errorMsg": "Invalid lamp ID.", "statusCode": 400 })
+                        continue
+                    # One patch per lamp, a repeat would silently replace the earlier one
+                    if object_lamp_id in updates:
+                        results.append({ "lampId": lamp_id, "errorMsg": "Lamp appears more than once in the batch.", "statusCode": 400 })
+                        continue
+                    try:
+                        update_fields = self.validate_patch(item)
+                    except ValueError as ex:
+                        results.append({ "lampId": lamp_id, "errorMsg": str(ex), "statusCode": 400 })
+                        continue
+                        
+                    update_fields["updated_at"] = updated_at
+                    update_fields["updated_by"] = updated_by
+                    updates[object_lamp_id] = update_fields
+                    results.append({ "lampId": lamp_id, "objectId": object_lamp_id })
+                    
+                # One query tells which of the requested lamps exist and belong to the caller
+                lamps = {
+                    lamp["_id"]: lamp["led"]
+                    for lamp in lamp_collection.find({ "_id": { "$in": list(updates) }, "created_by": decode_user_id }, { "_id": 1, "led": 1 })
+                }
+                if any(object_lamp_id in lamps for object_lamp_id in updates):
+                    # One version for the whole batch
+                    with self.database.next_version(decode_user_id) as version:
+                        operations = [
+                            UpdateOne({ "_id": object_lamp_id }, { "$set": { **update_fields, "version": version } })
+                            for object_lamp_id, update_fields in updates.items() if object_lamp_id in lamps
+                        ]
+                        lamp_collection.bulk_write(operations, ordered=False)
+                    
+                for result in results:
+                    object_lamp_id = result.pop("objectId", None)
+                    if object_lamp_id is None:
+                        continue
+                    if object_lamp_id in lamps:
+                        result["statusCode"] = 200
+                    else:
+                        result["errorMsg"] = "Lamp not found."
+                        result["statusCode"] = 404
+                        
+                for object_lamp_id in updates:
+                    if object_lamp_id in lamps:
+                        self.publish_change("updated", decode_user_id, object_lamp_id, lamps[object_lamp_id])
+                        
                 return jsonify({
                     "successMsg": "Update successful.",
+                    "data": results,
                     "statusCode": 200
                 }), 200
                 
@@ -326,6 +833,7 @@ class LampApi:
                 
                 
         @self.blueprint.route("/api/delete_lamp/<user_id>/<lamp_id>", methods=["DELETE"])
+        @self.auth.require_user
         def api_delete_lamp(user_id, lamp_id):
             if request.method != "DELETE":
                 return jsonify({
@@ -334,48 +842,258 @@ class LampApi:
                 }), 405
                 
             try:
-                # Decode the user id
-                decode_user_id = base64.urlsafe_b64decode(user_id).decode()
-                object_user_id = ObjectId(decode_user_id)
-                user_collection = self.database.database_connection("users")
-                # Find user in database
-                user = user_collection.find_one({ "_id": object_user_id })
-                if not user:
-                    return jsonify({
-                        "errorMsg": "Invalid ID.",
-                        "statusCode": 404
-                    })
-                    
+                decode_user_id = g.user_id
+                
                 # Decode the lamp id
                 decode_lamp_id = base64.urlsafe_b64decode(lamp_id).decode()
                 object_lamp_id = ObjectId(decode_lamp_id)
                 lamp_collection = self.database.database_connection("lamps")
                 # Find lamp in database
-                lamp = lamp_collection.find_one({ "_id": object_lamp_id })
+                lamp = self.lamp_cache.get_lamp(lamp_collection, object_lamp_id)
                 
-                if not lamp:
+                if not lamp or lamp.get("created_by") != decode_user_id:
                     return jsonify({
                         "errorMsg": "Lamp not found.",
                         "statusCode": 404
                     }), 404
                     
-                qr_image_path = lamp["qr_image_path"]
-                # Check if the file exists before attempting to delete
-                if os.path.exists(qr_image_path):
-                    os.remove(qr_image_path)
-                    
                 deleted_collection = self.database.database_connection("deleted_datas")
                 deleted_data = {}
                 deleted_data["deleted_lamp_id"] = decode_lamp_id
                 deleted_data["deleted_by"] = decode_user_id
-                deleted_collection.insert_one(deleted_data)
-                    
-                lamp_collection.delete_one({ "_id": object_lamp_id })
+                # Tombstone for delta sync, see /api/lamp_changes
+                deleted_data["led"] = lamp["led"]
+                with self.database.next_version(decode_user_id) as version:
+                    deleted_data["version"] = version
+                    deleted_collection.insert_one(deleted_data)
+                    lamp_collection.delete_one({ "_id": object_lamp_id, "created_by": decode_user_id })
+                if self.write_buffer:
+                    self.write_buffer.discard(object_lamp_id)
+                self.publish_change("deleted", decode_user_id, object_lamp_id, lamp["led"])
+                self.remove_qr_images(lamp)
                 return jsonify({
                     "successMsg": "Deleted successful.",
                     "statusCode": 200
                 }), 200
                 
+            except Exception as ex:
+                self.logging.log_debug(str(ex))
+                return jsonify({
+                    "errorMsg": str(ex),
+                    "statusCode": 500
+                }), 500
+                
+                
+        @self.blueprint.route("/api/device/lamps/<user_id>", methods=["GET"])
+        @self.auth.require_device
+        def api_device_lamps(user_id):
+            # Compact lamp state for the board controller, see DeviceSnapshot for the layout
+            try:
+                frame_format = request.args.get("format", "csv")
+                if frame_format not in ("csv", "bin"):
+                    return Response("Invalid format. Allowed: csv, bin.", status=400, mimetype="text/plain")
+                    
+                # With ?wait=1 the request blocks until a lamp changes after event `lastEventId`
+                event_id = self.events.version
+                if request.args.get("wait") in ("1", "true"):
+                    try:
+                        last_event_id, timeout = self.parse_wait_args()
+                    except ValueError:
+                        return Response("lastEventId and timeout must be numbers.", status=400, mimetype="text/plain")
+                        
+                    if not self.acquire_waiter():
+                        return Response("Too many clients are waiting for changes.", status=503, mimetype="text/plain", headers={ "Retry-After": str(self.busy_retry_after) })
+                    try:
+                        event_id, events = self.events.wait(last_event_id, timeout, topic=self.topic(g.user_id))
+                    finally:
+                        self.release_waiter()
+                    if events == []:
+                        return Response(status=304, headers={ "X-Lamp-Event-Id": str(event_id) })
+                    
+                mimetype = "text/csv" if frame_format == "csv" else "application/octet-stream"
+                return Response(
+                    self.device_snapshot.get(g.user_id, frame_format),
+                    status=200,
+                    mimetype=mimetype,
+                    headers={ "X-Lamp-Event-Id": str(event_id) }
+                )
+            
+            except Exception as ex:
+                self.logging.log_debug(str(ex))
+                return Response(str(ex), status=500, mimetype="text/plain")
+                
+                
+        @self.blueprint.route("/api/lamp_changes/<user_id>", methods=["GET"])
+        @self.auth.require_user
+        def api_lamp_changes(user_id):
+            # Delta sync: lamps created, updated or deleted after version `since`
+            # since=0 returns every lamp, the client then sends the returned version on its next call
+            try:
+                try:
+                    since = int(request.args.get("since", 0))
+                except ValueError:
+                    return jsonify({
+                        "errorMsg": "since must be a number.",
+                        "statusCode": 400
+                    }), 400
+                    
+                # Read before the queries: every version up to it is written, later writes are sent next time
+                version = self.database.committed_version(g.user_id)
+                
+                lamp_collection = self.database.database_connection("lamps")
+                query = { "created_by": g.user_id }
+                if since > 0:
+                    query["version"] = { "$gt": since }
+                changed = list(lamp_collection.find(query).sort("version", 1))
+                for lamp in changed:
+                    if self.write_buffer:
+                        self.write_buffer.overlay(lamp)
+                    lamp["_id"] = base64.urlsafe_b64encode(str(lamp["_id"]).encode()).decode()
+                    
+                deleted = []
+                if since > 0:
+                    deleted_collection = self.database.database_connection("deleted_datas")
+                    tombstones = deleted_collection.find(
+                        # Only owners can delete, so deleted_by is the owner
+                        { "deleted_by": g.user_id, "version": { "$gt": since } },
+                        { "_id": 0, "deleted_lamp_id": 1, "led": 1, "version": 1 }
+                    ).sort("version", 1)
+                    deleted = [{
+                        "lampId": base64.urlsafe_b64encode(tombstone["deleted_lamp_id"].encode()).decode(),
+                        "led": tombstone.get("led"),
+                        "version": tombstone["version"]
+                    } for tombstone in tombstones]
+                    
+                return jsonify({
+                    "successMsg": "Retrieve successful.",
+                    "data": {
+                        "changed": changed,
+                        "deleted": deleted
+                    },
+                    "version": version,
+                    "statusCode": 200
+                }), 200
+                
+            except Exception as ex:
+                self.logging.log_debug(str(ex))
+                return jsonify({
+                    "errorMsg": str(ex),
+                    "statusCode": 500
+                }), 500
+                
+                
+        @self.blueprint.route("/api/lamp_events/<user_id>", methods=["GET"])
+        @self.auth.require_user
+        def api_lamp_events(user_id):
+            # Long-poll: returns as soon as a lamp changes after event `lastEventId`, or empty on timeout
+            try:
+                try:
+                    last_event_id, timeout = self.parse_wait_args()
+                except ValueError:
+                    return jsonify({
+                        "errorMsg": "lastEventId and timeout must be numbers.",
+                        "statusCode": 400
+                    }), 400
+                    
+                # timeout=0 answers right away and does not need a waiter slot
+                if timeout > 0 and not self.acquire_waiter():
+                    return self.busy_response()
+                try:
+                    event_id, events = self.events.wait(last_event_id, timeout, topic=self.topic(g.user_id))
+                finally:
+                    if timeout > 0:
+                        self.release_waiter()
+                return jsonify({
+                    "successMsg": "Retrieve successful.",
+                    # Passed back as lastEventId, not a lamp version for /api/lamp_changes
+                    "eventId": event_id,
+                    # A client too far behind has to reload the lamp list
+                    "resync": events is None,
+                    "data": [event["data"] for event in events or []],
+                    "statusCode": 200
+                }), 200
+            
+            except Exception as ex:
+                self.logging.log_debug(str(ex))
+                return jsonify({
+                    "errorMsg": str(ex),
+                    "statusCode": 500
+                }), 500
+                
+                
+        @self.blueprint.route("/api/lamp_events/stream/<user_id>", methods=["GET"])
+        @self.auth.require_user
+        def api_lamp_events_stream(user_id):
+            # Server-Sent Events, reconnecting clients resume from the Last-Event-ID header
+            try:
+                try:
+                    last_event_id = int(request.headers.get("Last-Event-ID", request.args.get("lastEventId", self.events.version)))
+                except ValueError:
+                    return jsonify({
+                        "errorMsg": "Last-Event-ID and lastEventId must be numbers.",
+                        "statusCode": 400
+                    }), 400
+                    
+                # Read here, the generator runs after the request context is gone
+                topic = self.topic(g.user_id)
+                
+                # Held until the response is closed, i.e. for as long as the client stays connected
+                if not self.acquire_waiter():
+                    return self.busy_response()
+                
+            except Exception as ex:
+                self.logging.log_debug(str(ex))
+                return jsonify({
+                    "errorMsg": str(ex),
+                    "statusCode": 500
+                }), 500
+                
+            def generate(last_event_id):
+                while not self.events.closed:
+                    event_id, events = self.events.wait(last_event_id, self.default_wait_timeout, topic=topic)
+                    if events is None:
+                        yield f"id: {event_id}\nevent: resync\ndata: {{}}\n\n"
+                    elif events:
+                        for event in events:
+                            yield f"id: {event['version']}\nevent: lamp\ndata: {json.dumps(event['data'])}\n\n"
+                    else:
+                        # Comment line keeps proxies from closing an idle connection
+                        yield ": keepalive\n\n"
+                    last_event_id = event_id
+                    
+            response = Response(generate(last_event_id), mimetype="text/event-stream", headers={ "Cache-Control": "no-cache" })
+            response.call_on_close(self.release_waiter)
+            return response
+                
+                
+        @self.blueprint.route("/api/lamp_qr/<qr_id>", methods=["GET"])
+        def api_lamp_qr(qr_id):
+            # Rendered on demand and cached, the image for a qr_id never changes
+            try:
+                if not self.qr_images.is_valid(qr_id):
+                    return jsonify({
+                        "errorMsg": "Invalid QR ID.",
+                        "statusCode": 400
+                    }), 400
+                    
+                etag = self.qr_images.etag(qr_id)
+                headers = {
+                    "ETag": f'"{etag}"',
+                    "Cache-Control": "public, max-age=31536000, immutable"
+                }
+                if etag in request.if_none_match:
+                    return Response(status=304, headers=headers)
+                    
+                # Only render images for lamps that exist, so the disk cache stays bounded
+                lamp_collection = self.database.database_connection("lamps")
+                if not lamp_collection.find_one({ "qr_id": qr_id }, { "_id": 1 }):
+                    return jsonify({
+                        "errorMsg": "Lamp not found.",
+                        "statusCode": 404
+                    }), 404
+                    
+                return Response(self.qr_images.get(qr_id), status=200, mimetype="image/png", headers=headers)
+            
             except Exception as ex:
                 self.logging.log_debug(str(ex))
                 return jsonify({
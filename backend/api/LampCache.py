@@ -0,0 +1,55 @@
+import threading
+from Cache import Cache
+
+class LampCache:
+
+    """
+    * Read-through cache of lamp documents (by lamp id) and of serialized list responses (by owner and query string)
+    * The create, update and delete paths call invalidate() right after their write
+    * Lists are keyed by owner generation too, so a change only drops its owner's cached lists
+    * A fill is dropped when an invalidation happened while its query ran, so a slow reader never caches pre-write data
+    * Entries also expire after ttl, which bounds how stale another gunicorn worker can be
+    """
+
+    def __init__(self, max_size=10000, list_max_size=256, ttl=5) -> None:
+        self.lamps = Cache(max_size, ttl)
+        self.lists = Cache(list_max_size, ttl)
+        self._generation = 0
+        # owner -> generation of its lists, bumped by invalidate
+        self._owner_generations = {}
+        self._lock = threading.Lock()
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def get_lamp(self, lamp_collection, object_lamp_id):
+        # Returns a copy, callers change _id before responding
+        key = str(object_lamp_id)
+        lamp = self.lamps.get(key)
+        if lamp is None:
+            generation = self._generation
+            lamp = lamp_collection.find_one({ "_id": object_lamp_id })
+            if lamp is None:
+                return None
+            with self._lock:
+                if generation == self._generation:
+                    self.lamps.set(key, lamp)
+        return dict(lamp)
+
+    def get_list(self, owner, query_string):
+        return self.lists.get((owner, self._owner_generations.get(owner, 0), query_string))
+
+    def set_list(self, owner, query_string, body, generation):
+        # generation is read before the lamps were queried
+        with self._lock:
+            if generation == self._generation:
+                self.lists.set((owner, self._owner_generations.get(owner, 0), query_string), body)
+
+    def invalidate(self, owner, *object_lamp_ids):
+        with self._lock:
+            self._generation += 1
+            # Older lists of this owner become unreachable and age out of the LRU
+            self._owner_generations[owner] = self._owner_generations.get(owner, 0) + 1
+        for object_lamp_id in object_lamp_ids:
+            self.lamps.invalidate(str(object_lamp_id))
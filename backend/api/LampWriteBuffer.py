@@ -0,0 +1,163 @@
+import threading
+from collections import OrderedDict
+from contextlib import ExitStack
+import bson
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+from Metrics import Timer
+
+class LampWriteBuffer:
+
+    """
+    * Write-behind for single lamp updates, enabled with LAMP_WRITE_BEHIND=true
+    * Keeps the latest pending $set per lamp, later fields overwrite earlier ones (updated_at/updated_by included)
+    * A background thread writes all pending lamps with one unordered bulk_write every interval_ms
+    * Batches are written one after another, and each update only applies over an older updated_at,
+    * so a lamp never sees an older value after a newer one, also across gunicorn workers
+    * Each batch takes one lamp version per owner at flush time, so delta sync sees it once it is in Mongo
+    * Reads overlay the pending and in-flight state (see overlay), close() flushes what is left
+    """
+
+    def __init__(self, logging, database, interval_ms=50, max_batch=1000, on_flush=None, metrics=None) -> None:
+        self.logging = logging
+        self.database = database
+        # Called with an owner and its written lamp ids, e.g. to drop cached copies of them
+        self.on_flush = on_flush
+        self.interval = interval_ms / 1000
+        self.max_batch = max_batch
+        # lamp _id -> (owner, led, $set fields), waiting for the next flush
+        self._pending = OrderedDict()
+        # lamp _id -> $set fields, being written right now
+        self._inflight = {}
+        self._lock = threading.Lock()
+        # Serializes flushes between the background thread and flush() callers
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+
+        self.coalesced = None
+        self.flush_durations = None
+        if metrics is not None:
+            self.coalesced = metrics.counter("lamp_updates_coalesced_total", "Lamp updates merged into an already pending write.")
+            self.flush_durations = metrics.histogram("lamp_write_behind_flush_duration_seconds", "Write-behind bulk_write time in seconds.")
+
+        self.thread = threading.Thread(target=self.run, name="lamp-write-behind", daemon=True)
+        self.thread.start()
+
+    def add(self, object_lamp_id, owner, led, update_fields):
+        with self._lock:
+            pending = self._pending.get(object_lamp_id)
+            if pending is None:
+                self._pending[object_lamp_id] = (owner, led, dict(update_fields))
+            else:
+                pending[2].update(update_fields)
+                if self.coalesced is not None:
+                    self.coalesced.inc()
+            full = len(self._pending) >= self.max_batch
+        if full:
+            self._wake.set()
+
+    def led(self, object_lamp_id, owner):
+        # A pending lamp of this owner is known to exist, so the update route can skip its find_one
+        with self._lock:
+            pending = self._pending.get(object_lamp_id)
+            return pending[1] if pending is not None and pending[0] == owner else None
+
+    def pending(self, object_lamp_id):
+        # True while the lamp has fields that are not in Mongo yet (waiting or being written)
+        with self._lock:
+            return object_lamp_id in self._pending or object_lamp_id in self._inflight
+
+    def discard(self, object_lamp_id):
+        # Called when the lamp is deleted, its pending fields are not written anymore
+        with self._lock:
+            self._pending.pop(object_lamp_id, None)
+
+    def overlay(self, document):
+        # Applies not yet written fields, only the ones the document (or its projection) has
+        with self._lock:
+            fields = dict(self._inflight.get(document.get("_id")) or {})
+            pending = self._pending.get(document.get("_id"))
+        if pending is not None:
+            fields.update(pending[2])
+        for key, value in fields.items():
+            if key in document:
+                document[key] = value
+        return document
+
+    def run(self):
+        while not self._closed:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as ex:
+                # Keep the thread alive, otherwise pending updates would never be written again
+                self.logging.log_debug(f"Class: LampWriteBuffer | Method: run | ErorMsg: {ex}")
+
+    def encodable(self, batch):
+        # Backstop for fields bson cannot encode (LampApi validates them first), they would fail every retry
+        for object_lamp_id, (_, _, fields) in list(batch.items()):
+            try:
+                bson.encode(fields)
+            except Exception as ex:
+                self.logging.log_debug(f"Class: LampWriteBuffer | Method: flush | Lamp: {object_lamp_id} | Dropped | ErorMsg: {ex}")
+                del batch[object_lamp_id]
+        return batch
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                batch = self.encodable(self._pending)
+                self._pending = OrderedDict()
+                if not batch:
+                    return
+                self._inflight = { object_lamp_id: fields for object_lamp_id, (_, _, fields) in batch.items() }
+
+            try:
+                lamp_collection = self.database.database_connection("lamps")
+                with ExitStack() as stack:
+                    versions = {}
+                    for owner, _, _ in batch.values():
+                        if owner not in versions:
+                            versions[owner] = stack.enter_context(self.database.next_version(owner))
+                    # Another worker may have written a newer update of the same lamp meanwhile
+                    operations = [
+                        UpdateOne(
+                            { "_id": object_lamp_id, "updated_at": { "$lt": fields["updated_at"] } },
+                            { "$set": { **fields, "version": versions[batch[object_lamp_id][0]] } }
+                        )
+                        for object_lamp_id, fields in self._inflight.items()
+                    ]
+                    if self.flush_durations is not None:
+                        with Timer(self.flush_durations, ()):
+                            lamp_collection.bulk_write(operations, ordered=False)
+                    else:
+                        lamp_collection.bulk_write(operations, ordered=False)
+                if self.on_flush is not None:
+                    owners = {}
+                    for object_lamp_id, (owner, _, _) in batch.items():
+                        owners.setdefault(owner, []).append(object_lamp_id)
+                    for owner, object_lamp_ids in owners.items():
+                        self.on_flush(owner, *object_lamp_ids)
+            except PyMongoError as ex:
+                self.logging.log_debug(f"Class: LampWriteBuffer | Method: flush | Lamps: {len(batch)} | ErorMsg: {ex}")
+                with self._lock:
+                    # Put the batch back under anything that arrived meanwhile, the next flush retries it
+                    for object_lamp_id, (owner, led, fields) in batch.items():
+                        newer = self._pending.get(object_lamp_id)
+                        if newer is not None:
+                            fields.update(newer[2])
+                        self._pending[object_lamp_id] = (owner, led, fields)
+            finally:
+                with self._lock:
+                    self._inflight = {}
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+        self.thread.join()
+        # Whatever arrived after the thread's last flush
+        self.flush()
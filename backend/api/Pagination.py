@@ -0,0 +1,111 @@
+import base64
+import json
+import pymongo
+from bson import ObjectId
+
+class Pagination:
+
+    """
+    * Keyset (cursor) pagination and field projection for list endpoints
+    * Reads limit, cursor, sort and fields from the query string
+    * The cursor is the sort key of the last returned document, so each page is an index range scan
+    """
+
+    default_limit = 100
+    max_limit = 1000
+    # Sort key values a cursor may carry
+    cursor_value_types = (str, int, float, type(None))
+
+    def __init__(self, args, sort_fields=("_id",)) -> None:
+        self.sort_field = args.get("sort", sort_fields[0])
+        if self.sort_field not in sort_fields:
+            raise ValueError(f"Invalid sort field. Allowed: {', '.join(sort_fields)}.")
+
+        try:
+            self.limit = int(args.get("limit", self.default_limit))
+        except ValueError:
+            raise ValueError("Limit must be a number.")
+        if self.limit < 1 or self.limit > self.max_limit:
+            raise ValueError(f"Limit must be between 1 and {self.max_limit}.")
+
+        self.after = self.decode_cursor(args.get("cursor"))
+        self.fields = self.parse_fields(args.get("fields"))
+
+    def decode_cursor(self, cursor):
+        if not cursor:
+            return None
+
+        try:
+            content = json.loads(base64.urlsafe_b64decode(cursor).decode())
+            if content["sort"] != self.sort_field:
+                raise ValueError
+            # The value goes into the query, an object such as { "$exists": true } would run as an operator
+            value = content["value"]
+            if isinstance(value, bool) or not isinstance(value, self.cursor_value_types):
+                raise ValueError
+            return value, ObjectId(content["id"])
+        except Exception:
+            raise ValueError("Invalid cursor.")
+
+    def encode_cursor(self, document):
+        content = {
+            "sort": self.sort_field,
+            "value": document.get(self.sort_field) if self.sort_field != "_id" else None,
+            "id": str(document["_id"])
+        }
+        return base64.urlsafe_b64encode(json.dumps(content).encode()).decode()
+
+    def parse_fields(self, fields):
+        if not fields:
+            return None
+
+        names = [name.strip() for name in fields.split(",") if name.strip()]
+        excluded = [name[1:] for name in names if name.startswith("-")]
+        included = [name for name in names if not name.startswith("-")]
+        if excluded and included:
+            raise ValueError("Fields cannot mix included and excluded (-) names.")
+        if "_id" in excluded or self.sort_field in excluded:
+            raise ValueError(f"Fields cannot exclude _id or {self.sort_field}.")
+
+        if excluded:
+            return { name: 0 for name in excluded }
+
+        # _id and the sort key are always returned so the next cursor can be built
+        projection = { name: 1 for name in included }
+        projection[self.sort_field] = 1
+        return projection
+
+    def query(self, base_query=None):
+        query = dict(base_query or {})
+        if self.after is None:
+            return query
+
+        value, object_id = self.after
+        if self.sort_field == "_id":
+            query["_id"] = { "$gt": object_id }
+        else:
+            query["$or"] = [
+                { self.sort_field: { "$gt": value } },
+                { self.sort_field: value, "_id": { "$gt": object_id } }
+            ]
+        return query
+
+    def sort(self):
+        if self.sort_field == "_id":
+            return [("_id", pymongo.ASCENDING)]
+        return [(self.sort_field, pymongo.ASCENDING), ("_id", pymongo.ASCENDING)]
+
+    def find(self, collection, base_query=None):
+        # Fetch one extra document to know whether another page exists
+        return collection.find(self.query(base_query), self.fields).sort(self.sort()).limit(self.limit + 1)
+
+    def find_all(self, collection, base_query=None):
+        # Same range and projection without the page limit, used when streaming
+        return collection.find(self.query(base_query), self.fields).sort(self.sort())
+
+    def page(self, documents):
+        if len(documents) <= self.limit:
+            return documents, None
+
+        documents = documents[:self.limit]
+        return documents, self.encode_cursor(documents[-1])
\ No newline at end of file
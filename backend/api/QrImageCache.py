@@ -0,0 +1,85 @@
+import io
+import os
+import re
+import hashlib
+import threading
+import time
+import importlib.metadata
+import qrcode
+from Cache import Cache
+
+class QrImageCache:
+
+    """
+    * Renders lamp QR images on demand from the qr_id
+    * Rendered PNGs are kept in a bounded in-memory LRU and a content-addressed on-disk cache
+    * Disk layout: <images base>/qr/<hash[0:2]>/<hash[2:4]>/<hash>.png
+    * The hash covers the qrcode version, so an upgrade never serves a stale image
+    """
+
+    qr_id_pattern = re.compile(r"^[a-f0-9]{32}$")
+    render_version = importlib.metadata.version("qrcode")
+
+    def __init__(self, logging, images_path, max_size=512, metrics=None) -> None:
+        self.logging = logging
+        self.render_durations = None
+        if metrics is not None:
+            self.render_durations = metrics.histogram("qr_render_duration_seconds", "QR image render time in seconds.")
+        self.cache_path = os.path.join(images_path, "qr")
+        self.memory = Cache(max_size=max_size)
+
+    def is_valid(self, qr_id):
+        return bool(self.qr_id_pattern.match(qr_id))
+
+    def etag(self, qr_id):
+        return hashlib.sha256(f"{self.render_version}:{qr_id}".encode()).hexdigest()
+
+    def image_path(self, etag):
+        return os.path.join(self.cache_path, etag[0:2], etag[2:4], f"{etag}.png")
+
+    def discard(self, qr_id):
+        # Called when the lamp is deleted, its image is never served again
+        etag = self.etag(qr_id)
+        self.memory.invalidate(etag)
+        try:
+            os.remove(self.image_path(etag))
+        except FileNotFoundError:
+            pass
+        except OSError as ex:
+            self.logging.log_debug(f"Class: QrImageCache | Method: discard | ErorMsg: {ex}")
+
+    def get(self, qr_id):
+        etag = self.etag(qr_id)
+        image = self.memory.get(etag)
+        if image is not None:
+            return image
+
+        image_path = self.image_path(etag)
+        try:
+            with open(image_path, "rb") as file:
+                image = file.read()
+        except FileNotFoundError:
+            image = self.render(qr_id)
+            self.store(image_path, image)
+
+        self.memory.set(etag, image)
+        return image
+
+    def render(self, qr_id):
+        started = time.perf_counter()
+        buffer = io.BytesIO()
+        qrcode.make(qr_id).save(buffer)
+        if self.render_durations is not None:
+            self.render_durations.observe(time.perf_counter() - started)
+        return buffer.getvalue()
+
+    def store(self, image_path, image):
+        # Write then rename so a concurrent reader never sees a partial file
+        try:
+            os.makedirs(os.path.dirname(image_path), exist_ok=True)
+            temporary_path = f"{image_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temporary_path, "wb") as file:
+                file.write(image)
+            os.replace(temporary_path, image_path)
+        except OSError as ex:
+            self.logging.log_debug(f"Class: QrImageCache | Method: store | ErorMsg: {ex}")
\ No newline at end of file
@@ -0,0 +1,63 @@
+import base64
+from flask import Response, current_app, stream_with_context
+
+class Streaming:
+
+    """
+    * Streams a pymongo cursor as a JSON array or NDJSON, one document at a time
+    * Peak memory is one cursor batch no matter how large the collection is
+    * Asked for with ?stream=1 or with the header Accept: application/x-ndjson
+    """
+
+    ndjson_mimetype = "application/x-ndjson"
+    default_batch_size = 500
+
+    def __init__(self, logging) -> None:
+        self.logging = logging
+
+    def wants_stream(self, request):
+        if request.args.get("stream") in ("1", "true"):
+            return True
+        return request.accept_mimetypes.best == self.ndjson_mimetype
+
+    def wants_ndjson(self, request):
+        return request.accept_mimetypes.best == self.ndjson_mimetype
+
+    @staticmethod
+    def encode_id(document):
+        # Convert object id to random string byte (after encoding it to bytes first)
+        document["_id"] = base64.urlsafe_b64encode(str(document["_id"]).encode()).decode()
+        return document
+
+    def response(self, request, cursor, success_msg, encode=None):
+        encode = encode or self.encode_id
+        cursor = cursor.batch_size(self.default_batch_size)
+        dumps = current_app.json.dumps
+
+        if self.wants_ndjson(request):
+            def generate():
+                try:
+                    for document in cursor:
+                        yield dumps(encode(document)) + "\n"
+                except Exception as ex:
+                    self.logging.log_debug(f"Class: Streaming | Method: response | ErorMsg: {ex}")
+                finally:
+                    cursor.close()
+
+            return Response(stream_with_context(generate()), mimetype=self.ndjson_mimetype)
+
+        def generate():
+            try:
+                yield '{"successMsg": ' + dumps(success_msg) + ', "statusCode": 200, "data": ['
+                separator = ""
+                for document in cursor:
+                    yield separator + dumps(encode(document))
+                    separator = ","
+                yield "]}"
+            except Exception as ex:
+                # Headers are already sent, so the truncated body is the only error signal
+                self.logging.log_debug(f"Class: Streaming | Method: response | ErorMsg: {ex}")
+            finally:
+                cursor.close()
+
+        return Response(stream_with_context(generate()), mimetype="application/json")
\ No newline at end of file
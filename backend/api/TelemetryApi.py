@@ -0,0 +1,138 @@
+import struct
+from datetime import datetime, timezone
+from flask import request, jsonify, Blueprint, g
+from api.TelemetryBuffer import TelemetryBuffer, TelemetryBufferFull
+
+class TelemetryApi:
+
+    """
+    * Current readings from the board controllers (ACS712), buffered and written in batches
+    *
+    * JSON body:
+    *   { "t0": <epoch ms>, "samples": [[offset ms, led, current mA], ...] }
+    * Binary body (Content-Type: application/octet-stream, big-endian):
+    *   header  "TLM" | version (uint8) | count (uint16) | t0 epoch ms (uint64)
+    *   record  offset ms (uint32) | led (uint16) | current mA (int16)
+    """
+
+    frame_magic = b"TLM"
+    frame_version = 1
+    header_format = ">3sBHQ"
+    record_format = ">IHh"
+    # Value ranges of the binary record (uint32, uint16, int16)
+    max_offset = 2 ** 32 - 1
+    max_led = 2 ** 16 - 1
+    min_current = -2 ** 15
+    max_current = 2 ** 15 - 1
+
+    def __init__(self, name, logging, database, auth, config, on_flush=None, metrics=None) -> None:
+        self.blueprint = Blueprint("telemetry", name)
+        self.database = database
+        self.logging = logging
+        self.auth = auth
+        self.max_readings = config.telemetry.max_readings_per_request
+        self.buffer = TelemetryBuffer(
+            logging,
+            database,
+            max_size=config.telemetry.buffer_size,
+            batch_size=config.telemetry.batch_size,
+            interval_ms=config.telemetry.flush_interval_ms,
+            retry_after=config.telemetry.retry_after,
+            on_flush=on_flush,
+            metrics=metrics
+        )
+        self.register_route()
+
+    def close(self):
+        # Writes buffered readings, call on shutdown
+        self.buffer.close()
+
+    def parse_binary(self, body):
+        header_size = struct.calcsize(self.header_format)
+        record_size = struct.calcsize(self.record_format)
+        if len(body) < header_size:
+            raise ValueError("Frame is shorter than its header.")
+
+        magic, version, count, t0 = struct.unpack_from(self.header_format, body)
+        if magic != self.frame_magic or version != self.frame_version:
+            raise ValueError("Unknown frame type or version.")
+        if len(body) != header_size + count * record_size:
+            raise ValueError("Frame length does not match its count.")
+        return t0, struct.iter_unpack(self.record_format, memoryview(body)[header_size:]), count
+
+    def parse_json(self, body):
+        if not isinstance(body, dict) or not isinstance(body.get("samples"), list):
+            raise ValueError("Provide t0 and samples.")
+        t0 = body.get("t0")
+        if not isinstance(t0, (int, float)) or isinstance(t0, bool) or t0 < 0:
+            raise ValueError("t0 must be epoch milliseconds.")
+        samples = body["samples"]
+        for sample in samples:
+            if not isinstance(sample, list) or len(sample) != 3 or not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in sample):
+                raise ValueError("Each sample must be [offset ms, led, current mA].")
+            # Same ranges as the binary record, so both bodies store the same kind of readings
+            offset, led, current_ma = sample
+            if not 0 <= offset <= self.max_offset or not isinstance(led, int) or not 0 <= led <= self.max_led or not self.min_current <= current_ma <= self.max_current:
+                raise ValueError(f"Samples need 0 <= offset <= {self.max_offset}, an integer led 0-{self.max_led} and {self.min_current} <= current <= {self.max_current}.")
+        return t0, samples, len(samples)
+
+    def register_route(self):
+
+        @self.blueprint.route("/api/telemetry/<user_id>", methods=["POST"])
+        @self.auth.require_device
+        def api_ingest_telemetry(user_id):
+            # One request carries a whole batch, readings are written later by TelemetryBuffer
+            try:
+                try:
+                    if request.mimetype == "application/octet-stream":
+                        t0, samples, count = self.parse_binary(request.get_data())
+                    else:
+                        t0, samples, count = self.parse_json(request.get_json(silent=True))
+                except (ValueError, struct.error) as ex:
+                    return jsonify({
+                        "errorMsg": str(ex),
+                        "statusCode": 400
+                    }), 400
+
+                if count > self.max_readings:
+                    return jsonify({
+                        "errorMsg": f"At most {self.max_readings} readings per request.",
+                        "statusCode": 413
+                    }), 413
+
+                received_at = datetime.now(timezone.utc)
+                try:
+                    readings = [{
+                        "ts": datetime.fromtimestamp((t0 + offset) / 1000, tz=timezone.utc),
+                        "meta": { "user": g.user_id, "led": int(led) },
+                        "current_ma": current_ma,
+                        "received_at": received_at
+                    } for offset, led, current_ma in samples]
+                except (OverflowError, OSError, ValueError):
+                    return jsonify({
+                        "errorMsg": "t0 plus offset must be a valid time.",
+                        "statusCode": 400
+                    }), 400
+
+                try:
+                    self.buffer.add(readings)
+                except TelemetryBufferFull as ex:
+                    response = jsonify({
+                        "errorMsg": str(ex),
+                        "statusCode": 503
+                    })
+                    response.headers["Retry-After"] = str(ex.retry_after)
+                    return response, 503
+
+                return jsonify({
+                    "successMsg": "Readings accepted.",
+                    "accepted": len(readings),
+                    "statusCode": 202
+                }), 202
+
+            except Exception as ex:
+                self.logging.log_debug(str(ex))
+                return jsonify({
+                    "errorMsg": str(ex),
+                    "statusCode": 500
+                }), 500
@@ -0,0 +1,132 @@
+import threading
+from collections import deque
+from pymongo.errors import PyMongoError, BulkWriteError
+from Metrics import Timer
+
+class TelemetryBufferFull(Exception):
+
+    """
+    * Raised when a batch does not fit in the buffer, the API answers 503 with Retry-After
+    """
+
+    def __init__(self, retry_after) -> None:
+        super().__init__("Telemetry buffer is full. Please try again later.")
+        self.retry_after = retry_after
+
+class TelemetryBuffer:
+
+    """
+    * In-memory buffer of sensor readings in front of the lamp_readings time-series collection
+    * A background thread inserts them with insert_many once batch_size readings wait or every interval_ms
+    * At most max_size readings are held, a batch that does not fit is rejected whole (TelemetryBufferFull)
+    * on_flush gets every written batch, e.g. to update energy rollups
+    """
+
+    def __init__(self, logging, database, max_size=100000, batch_size=5000, interval_ms=1000, retry_after=1, on_flush=None, metrics=None) -> None:
+        self.logging = logging
+        self.database = database
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.interval = interval_ms / 1000
+        self.retry_after = retry_after
+        self.on_flush = on_flush
+        self._readings = deque()
+        self._lock = threading.Lock()
+        # Serializes flushes between the background thread and close()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+
+        self.received = None
+        self.rejected = None
+        self.flush_durations = None
+        if metrics is not None:
+            self.received = metrics.counter("telemetry_readings_received_total", "Sensor readings accepted into the buffer.")
+            self.rejected = metrics.counter("telemetry_readings_rejected_total", "Sensor readings rejected or lost.", ("reason",))
+            self.flush_durations = metrics.histogram("telemetry_flush_duration_seconds", "insert_many time per telemetry batch in seconds.")
+
+        self.thread = threading.Thread(target=self.run, name="telemetry-writer", daemon=True)
+        self.thread.start()
+
+    def __len__(self):
+        return len(self._readings)
+
+    def add(self, readings):
+        with self._lock:
+            if self._closed or len(self._readings) + len(readings) > self.max_size:
+                if self.rejected is not None:
+                    self.rejected.inc((("reason", "full"),), len(readings))
+                raise TelemetryBufferFull(self.retry_after)
+            self._readings.extend(readings)
+            full = len(self._readings) >= self.batch_size
+        if self.received is not None:
+            self.received.inc((), len(readings))
+        if full:
+            self._wake.set()
+
+    def run(self):
+        while not self._closed:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as ex:
+                # Keep the thread alive, otherwise the buffer fills up and every request gets 503
+                self.logging.log_debug(f"Class: TelemetryBuffer | Method: run | ErorMsg: {ex}")
+
+    def flush(self):
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    count = min(len(self._readings), self.batch_size)
+                    batch = [self._readings.popleft() for _ in range(count)]
+                # Stop at the first failure, the next flush retries
+                if not batch or not self.write(batch):
+                    return
+
+    def write(self, batch):
+        try:
+            reading_collection = self.database.database_connection("lamp_readings")
+            if self.flush_durations is not None:
+                with Timer(self.flush_durations, ()):
+                    reading_collection.insert_many(batch, ordered=False)
+            else:
+                reading_collection.insert_many(batch, ordered=False)
+        except BulkWriteError as ex:
+            # Unordered, so only the listed readings are missing
+            failed = { error["index"] for error in ex.details.get("writeErrors", []) }
+            self.logging.log_debug(f"Class: TelemetryBuffer | Method: write | Failed: {len(failed)} | ErorMsg: {ex}")
+            if self.rejected is not None:
+                self.rejected.inc((("reason", "invalid"),), len(failed))
+            batch = [reading for index, reading in enumerate(batch) if index not in failed]
+        except PyMongoError as ex:
+            self.logging.log_debug(f"Class: TelemetryBuffer | Method: write | Readings: {len(batch)} | ErorMsg: {ex}")
+            with self._lock:
+                # Back in front for the next flush while there is room, otherwise the batch is lost
+                if len(self._readings) + len(batch) <= self.max_size and not self._closed:
+                    self._readings.extendleft(reversed(batch))
+                    return False
+            if self.rejected is not None:
+                self.rejected.inc((("reason", "lost"),), len(batch))
+            return False
+        except Exception as ex:
+            # e.g. bson cannot encode a reading, retrying the same batch would fail again
+            self.logging.log_debug(f"Class: TelemetryBuffer | Method: write | Dropped: {len(batch)} | ErorMsg: {ex}")
+            if self.rejected is not None:
+                self.rejected.inc((("reason", "invalid"),), len(batch))
+            return True
+
+        if self.on_flush is not None and batch:
+            try:
+                self.on_flush(batch)
+            except Exception as ex:
+                # The readings are stored, a failing callback must not stop the writer
+                self.logging.log_debug(f"Class: TelemetryBuffer | Method: write | Callback | ErorMsg: {ex}")
+        return True
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+        self.thread.join()
+        # Whatever arrived after the thread's last flush
+        self.flush()
@@ -1,15 +1,28 @@
-import bcrypt
 import re
 import base64
-from flask import request, jsonify, Blueprint
+import jwt
+from bson import ObjectId
+from flask import request, jsonify, Blueprint, g
+from pymongo.errors import DuplicateKeyError
+from PasswordHasher import PasswordHasherBusy
 
 class UserApi:
     
-    def __init__(self, name, logging, database) -> None:
+    def __init__(self, name, logging, database, auth, password_hasher) -> None:
         self.blueprint = Blueprint("user", name)
-        self.register_route()
         self.database = database
         self.logging = logging
+        self.auth = auth
+        self.password_hasher = password_hasher
+        self.register_route()
+        
+    def busy_response(self, ex):
+        response = jsonify({
+            "errorMsg": str(ex),
+            "statusCode": 429
+        })
+        response.headers["Retry-After"] = str(ex.retry_after)
+        return response, 429
         
     def register_route(self):
         
@@ -48,15 +61,6 @@ class UserApi:
                 password = request_data["password"]
                 confirm_password = request_data["confirm_password"]
                 
-                user_collection = self.database.database_connection("users")
-                user = user_collection.find_one({ "email": email }, {"_id": 0})
-                
-                if user:
-                    return jsonify({
-                        "errorMsg": "Email already exists.",
-                        "statusCode": 409
-                    }), 409
-                    
                 # Check if confirm password is same as password
                 if confirm_password != password:
                     return jsonify({
@@ -91,28 +95,43 @@ class UserApi:
                         "statusCode": 400
                     }), 400
                     
-                # converting password to array of bytes 
-                passord_bytes = password.encode("utf-8")
-                
-                # Hash password with salt
-                # The '12' is the number that dictates the 'slowness'
-                hash_password = bcrypt.hashpw(passord_bytes, bcrypt.gensalt(12))
-                # decode the hash to prevent is encoded twice
-                decoded_hash_password = hash_password.decode("utf-8")
-                
-                user_collection.insert_one({
-                    "email": email,
-                    "full_name": full_name,
-                    "username": username,
-                    "phone": phone,
-                    "password": str(decoded_hash_password)
-                })
+                user_collection = self.database.database_connection("users")
+                # Cheap check first, so a duplicate registration never takes a bcrypt slot
+                if user_collection.find_one({ "email": email }, { "_id": 1 }):
+                    return jsonify({
+                        "errorMsg": "Email already exists.",
+                        "statusCode": 409
+                    }), 409
+                    
+                # Hash password with salt on the password worker pool
+                decoded_hash_password = self.password_hasher.hash(password)
+                
+                # The unique email index still rejects a registration that raced the check above
+                try:
+                    result = user_collection.insert_one({
+                        "email": email,
+                        "full_name": full_name,
+                        "username": username,
+                        "phone": phone,
+                        "password": str(decoded_hash_password)
+                    })
+                except DuplicateKeyError:
+                    return jsonify({
+                        "errorMsg": "Email already exists.",
+                        "statusCode": 409
+                    }), 409
+                
+                # Drop any stale cache entry for the new user id
+                self.database.invalidate_user(result.inserted_id)
                                
                 return jsonify({
                     "successMsg": "Register successful.",
                     "statusCode": 200
                     }), 200
                 
+            except PasswordHasherBusy as ex:
+                return self.busy_response(ex)
+                
             except Exception as ex:
                 self.logging.log_debug(str(ex))
                 return jsonify({
@@ -162,14 +181,8 @@ class UserApi:
                 # Convert the object id to string so that it can be return
                 user["_id"] = str(user["_id"])
                 
-                # Converting password to array of bytes 
-                passord_bytes = password.encode("utf-8")
-                
-                # Get user password from mongodb and convert it to byte
-                password_db = user["password"].encode("utf-8")
-                
                 # Checking password 
-                correct_password = bcrypt.checkpw(passord_bytes, password_db)
+                correct_password = self.password_hasher.verify(password, user["password"])
                 
                 if user and not correct_password:                        
                     return jsonify({
@@ -177,19 +190,133 @@ class UserApi:
                         "statusCode": 401,
                     })
                     
+                # Upgrade the stored hash when the configured cost has changed
+                if self.password_hasher.needs_rehash(user["password"]):
+                    try:
+                        user_collection.update_one(
+                            { "_id": ObjectId(user["_id"]) },
+                            { "$set": { "password": self.password_hasher.hash(password) } }
+                        )
+                    except PasswordHasherBusy:
+                        # Not worth failing the login for, the next one will retry
+                        pass
+                    
                 # Convert object id to random string byte (after encoding it to bytes first)
                 user_id_converted = base64.urlsafe_b64encode(user["_id"].encode()).decode()
                     
                 return jsonify({
                     "successMsg": "Authenticate successful.",
                     "userId": user_id_converted,
+                    **self.auth.issue_tokens(user["_id"]),
                     "statusCode": 200,
                 })
                 
                 
+            except PasswordHasherBusy as ex:
+                return self.busy_response(ex)
+                
             except Exception as ex:
                 self.logging.log_debug(str(ex))
                 return jsonify({
                     "errorMsg": str(ex),
                     "statusCode": 500
-                }), 500
\ No newline at end of file
+                }), 500
+                
+                
+        @self.blueprint.route("/api/refresh_token", methods=["POST"])
+        def api_refresh_token():
+            # Trades a refresh token for a new token pair, the old refresh token is revoked
+            try:
+                request_data = request.get_json(silent=True) or {}
+                if "refreshToken" not in request_data:
+                    return jsonify({
+                        "errorMsg":  "Bad Request - Missing Parameters",
+                        "missingParameters": ["refreshToken"],
+                        "statusCode": 400
+                    }), 400
+                    
+                try:
+                    claims = self.auth.verify(request_data["refreshToken"], "refresh")
+                except jwt.InvalidTokenError as ex:
+                    return jsonify({
+                        "errorMsg": f"Invalid token. {ex}",
+                        "statusCode": 401
+                    }), 401
+                    
+                self.auth.revoke(claims)
+                return jsonify({
+                    "successMsg": "Refresh successful.",
+                    **self.auth.issue_tokens(claims["sub"]),
+                    "statusCode": 200
+                }), 200
+                
+            except Exception as ex:
+                self.logging.log_debug(str(ex))
+                return jsonify({
+                    "errorMsg": str(ex),
+                    "statusCode": 500
+                }), 500
+                
+                
+        @self.blueprint.route("/api/logout", methods=["POST"])
+        def api_logout():
+            # Revokes the bearer access token and, when given, the refresh token
+            try:
+                request_data = request.get_json(silent=True) or {}
+                tokens = [
+                    (self.auth.bearer_token(), "access"),
+                    (request_data.get("refreshToken"), "refresh")
+                ]
+                for token, token_type in tokens:
+                    if not token:
+                        continue
+                    try:
+                        self.auth.revoke(self.auth.verify(token, token_type))
+                    except jwt.InvalidTokenError:
+                        # Already expired or revoked, nothing left to do
+                        pass
+                        
+                return jsonify({
+                    "successMsg": "Logout successful.",
+                    "statusCode": 200
+                }), 200
+                
+            except Exception as ex:
+                self.logging.log_debug(str(ex))
+                return jsonify({
+                    "errorMsg": str(ex),
+                    "statusCode": 500
+                }), 500
+                
+                
+        @self.blueprint.route("/api/device_token/<user_id>", methods=["POST", "DELETE"])
+        @self.auth.require_user
+        def api_device_token(user_id):
+            # POST issues the board controller token, replacing the previous one, DELETE revokes it
+            try:
+                # Needs a signed-in user, a bare user id must not be enough to mint a token
+                if g.token_claims is None:
+                    return jsonify({
+                        "errorMsg": "Missing bearer token.",
+                        "statusCode": 401
+                    }), 401
+                    
+                if request.method == "DELETE":
+                    self.auth.revoke_device_token(g.user_id)
+                    return jsonify({
+                        "successMsg": "Device token revoked.",
+                        "statusCode": 200
+                    }), 200
+                    
+                return jsonify({
+                    "successMsg": "Device token issued.",
+                    **self.auth.issue_device_token(g.user_id),
+                    "statusCode": 200
+                }), 200
+                
+            except Exception as ex:
+                self.logging.log_debug(str(ex))
+                return jsonify({
+                    "errorMsg": str(ex),
+                    "statusCode": 500
+                }), 500
@@ -1,27 +1,170 @@
-from flask import Flask
+import atexit
+import time
+import threading
+from flask import Flask, request, g
 
 # Import file
+from Config import Config, ConfigReloader
 from Logger import Logger
 from Database import Database
+from EventBus import EventBus
+from PasswordHasher import PasswordHasher
+from Auth import Auth
+from Metrics import Metrics
+from Profiler import Profiler
 from api.UserApi import UserApi
 from api.LampApi import LampApi
 from api.DeletedDatasApi import DeletedDatasApi
+from api.TelemetryApi import TelemetryApi
+from api.EnergyApi import EnergyApi
 
 
-# Initialize flask app
-app = Flask(__name__)
+def create_app(config=None):
+    """
+    * Builds the Flask app and every component it uses from one Config (loaded here when not given)
+    * Called once per process, under gunicorn once per worker after the fork (see wsgi.py)
+    * Components, the config reloader and shutdown() are kept in app.extensions["smart_lamp"]
+    """
 
-logging = Logger()
-database = Database(logging)
+    config = config or Config.load()
 
-user_api = UserApi(__name__, logging=logging, database=database)
-lamp_api = LampApi(__name__, logging=logging, database=database)
-deleted_data_api = DeletedDatasApi(__name__, logging=logging, database=database)
+    # Initialize flask app
+    app = Flask(__name__)
 
-# Register blueprints
-app.register_blueprint(user_api.blueprint)
-app.register_blueprint(lamp_api.blueprint)
-app.register_blueprint(deleted_data_api.blueprint)
+    logging = Logger(config.log)
+    metrics = Metrics()
+    database = Database(logging, config.database, metrics=metrics)
+    # Connect and ensure indexes before the first request is accepted
+    database.warm_up(expire_after={ "lamp_readings": config.telemetry.raw_ttl_days * 86400 })
+    events = EventBus()
+    password_hasher = PasswordHasher(
+        logging,
+        cost=config.password.cost,
+        workers=config.password.workers,
+        max_pending=config.password.max_pending,
+        metrics=metrics
+    )
+    auth = Auth(
+        logging,
+        database,
+        secret=config.auth.secret,
+        access_ttl=config.auth.access_ttl,
+        refresh_ttl=config.auth.refresh_ttl,
+        device_ttl=config.auth.device_ttl,
+        allow_legacy_user_id=config.auth.allow_legacy_user_id
+    )
+
+    user_api = UserApi(__name__, logging=logging, database=database, auth=auth, password_hasher=password_hasher)
+    lamp_api = LampApi(__name__, logging=logging, database=database, auth=auth, events=events, config=config, metrics=metrics)
+    deleted_data_api = DeletedDatasApi(__name__, logging=logging, database=database, auth=auth)
+    energy_api = EnergyApi(__name__, logging=logging, database=database, auth=auth, config=config, metrics=metrics)
+    # Every written batch of readings also updates the energy rollups
+    telemetry_api = TelemetryApi(__name__, logging=logging, database=database, auth=auth, config=config, on_flush=energy_api.rollup.apply, metrics=metrics)
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def log_request(response):
+        latency_ms = (time.perf_counter() - g.request_started) * 1000
+        logging.log_request(request.url_rule.rule if request.url_rule else request.path, request.method, response.status_code, latency_ms)
+        return response
+
+    def collect_runtime_stats():
+        # Cache and log queue counters, read when /metrics is scraped
+        families = []
+        caches = [
+            ("users", database.user_cache),
+            ("qr_images", lamp_api.qr_images.memory),
+            ("lamps", lamp_api.lamp_cache.lamps),
+            ("lamp_lists", lamp_api.lamp_cache.lists)
+        ]
+        for cache_name, cache in caches:
+            stats = cache.stats()
+            families.append((f"cache_{cache_name}_hits_total", "counter", f"{cache_name} cache hits.", [(f"cache_{cache_name}_hits_total", (), stats["hits"])]))
+            families.append((f"cache_{cache_name}_misses_total", "counter", f"{cache_name} cache misses.", [(f"cache_{cache_name}_misses_total", (), stats["misses"])]))
+            families.append((f"cache_{cache_name}_hit_ratio", "gauge", f"{cache_name} cache hit ratio since start.", [(f"cache_{cache_name}_hit_ratio", (), stats["hit_ratio"])]))
+        log_stats = logging.stats()
+        families.append(("log_records_dropped_total", "counter", "Log records dropped because the queue was full.", [("log_records_dropped_total", (), log_stats["dropped"])]))
+        families.append(("log_records_queued", "gauge", "Log records waiting to be written.", [("log_records_queued", (), log_stats["queued"])]))
+        families.append(("telemetry_readings_buffered", "gauge", "Sensor readings waiting to be written.", [("telemetry_readings_buffered", (), len(telemetry_api.buffer))]))
+        return families
+
+    metrics.add_collector(collect_runtime_stats)
+    metrics.init_app(app)
+
+    # Opt-in per request profiling, disabled unless PROFILE_TOKEN or PROFILE_SAMPLE_RATE is set
+    profiler = Profiler(
+        logging,
+        logging.base_log_path,
+        token=config.profile.token,
+        sample_rate=config.profile.sample_rate,
+        max_bytes=config.profile.max_bytes
+    )
+    profiler.init_app(app)
+
+    def apply_config(new_config):
+        # Settings that are safe to change while serving, see ConfigReloader.reloadable
+        logging.set_sampling(new_config.log.sampling)
+        password_hasher.cost = new_config.password.cost
+        auth.access_ttl = new_config.auth.access_ttl
+        auth.refresh_ttl = new_config.auth.refresh_ttl
+        auth.device_ttl = new_config.auth.device_ttl
+        auth.allow_legacy_user_id = new_config.auth.allow_legacy_user_id
+        database.user_cache.ttl = new_config.database.user_cache_ttl
+        auth.device_tokens.ttl = new_config.database.user_cache_ttl
+        profiler.token = new_config.profile.token
+        profiler.sample_rate = new_config.profile.sample_rate
+
+    # kill -HUP <pid> re-reads .env and paths.yaml
+    config_reloader = ConfigReloader(logging, config)
+    config_reloader.subscribe(apply_config)
+    config_reloader.install()
+
+    # Register blueprints
+    app.register_blueprint(user_api.blueprint)
+    app.register_blueprint(lamp_api.blueprint)
+    app.register_blueprint(deleted_data_api.blueprint)
+    app.register_blueprint(telemetry_api.blueprint)
+    app.register_blueprint(energy_api.blueprint)
+
+    shutdown_lock = threading.Lock()
+    shutdown_state = { "done": False }
+
+    def shutdown():
+        # Safe to call more than once (gunicorn worker_exit and atexit)
+        with shutdown_lock:
+            if shutdown_state["done"]:
+                return
+            shutdown_state["done"] = True
+        # Release long-poll and SSE waiters first so their requests can finish
+        events.close()
+        # Write pending write-behind lamp updates while the database is still open
+        lamp_api.close()
+        # Same for buffered sensor readings
+        telemetry_api.close()
+        password_hasher.close()
+        # Close the shared MongoClient
+        database.close_connection()
+        # Flush the log queue last so the steps above can still log
+        logging.stop()
+
+    atexit.register(shutdown)
+
+    app.extensions["smart_lamp"] = {
+        "config_reloader": config_reloader,
+        "logging": logging,
+        "metrics": metrics,
+        "database": database,
+        "events": events,
+        "password_hasher": password_hasher,
+        "auth": auth,
+        "shutdown": shutdown
+    }
+    return app
 
 if __name__ == "__main__":
+    # Development server only, production runs wsgi.py under gunicorn
+    app = create_app()
     app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,438 @@
+"""
+* Load test and benchmark for every API route
+* Builds the app with create_app against mongomock (default) or a local mongod, seeds users, lamps and deleted records,
+  then drives each route over HTTP at the configured concurrency
+* Reports throughput, p50/p95/p99 latency and the median peak allocation per request, and saves the run as JSON
+*
+* Run from the backend folder:
+*   pip install -r benchmarks/requirements.txt
+*   python benchmarks/benchmark.py --users 50 --lamps 500 --deleted 2000 --concurrency 8 --requests 400
+*   python benchmarks/benchmark.py --mongo-uri mongodb://127.0.0.1:27017 --compare benchmarks/results/<previous>.json
+* lamp_events_stream is timed to the first Server-Sent Event, then the connection is closed
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import random
+import platform
+import statistics
+import argparse
+import datetime
+import struct
+import tempfile
+import threading
+import subprocess
+import tracemalloc
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_PATH)
+
+PASSWORD = "Benchmark#2024"
+
+def patch_mongomock():
+    # pymongo 4.11+ passes sort (None unless asked for) to the bulk builder, mongomock 4.3 does not accept it
+    from mongomock.collection import BulkOperationBuilder
+    add_update = BulkOperationBuilder.add_update
+
+    def add_update_without_sort(self, *args, sort=None, **kwargs):
+        if sort is not None:
+            raise NotImplementedError("mongomock does not support sort on bulk updates.")
+        return add_update(self, *args, **kwargs)
+
+    BulkOperationBuilder.add_update = add_update_without_sort
+
+class Benchmark:
+
+    def __init__(self, args) -> None:
+        self.args = args
+        self.work_path = tempfile.mkdtemp(prefix="lamp-benchmark-")
+        self.counter = iter(range(10 ** 9))
+        self.counter_lock = threading.Lock()
+
+    def next_number(self):
+        with self.counter_lock:
+            return next(self.counter)
+
+    def boot(self):
+        # Logs and QR images go to the work folder, the rest of the settings come from .env
+        yaml_file = os.path.join(self.work_path, "paths.yaml")
+        os.makedirs(os.path.join(self.work_path, "logs"))
+        os.makedirs(os.path.join(self.work_path, "images"))
+        with open(yaml_file, "w") as file:
+            json.dump({
+                "log": { "base": os.path.join(self.work_path, "logs") },
+                "images": { "base": os.path.join(self.work_path, "images") }
+            }, file)
+
+        os.environ["DB_NAME"] = self.args.db_name
+        os.environ.setdefault("BCRYPT_COST", str(self.args.bcrypt_cost))
+        os.environ.setdefault("JWT_SECRET", "benchmark")
+        # The dev server starts a thread per request, there is no thread pool for waiters to exhaust
+        os.environ.setdefault("LAMP_MAX_WAITERS", "0")
+
+        import pymongo
+        from Config import Config
+        from Database import Database
+        config = Config.load(yaml_file=yaml_file)
+        if self.args.mongo_uri:
+            client = pymongo.MongoClient(self.args.mongo_uri)
+            client.drop_database(self.args.db_name)
+        else:
+            import mongomock
+            patch_mongomock()
+            client = mongomock.MongoClient()
+        # Injected before create_app builds its Database, so every component shares this client
+        Database(logging=None, config=config.database, client=client)
+
+        from app import create_app
+        from werkzeug.serving import make_server
+        self.app = create_app(config)
+        self.components = self.app.extensions["smart_lamp"]
+        self.server = make_server("127.0.0.1", 0, self.app, threaded=True)
+        self.port = self.server.server_port
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def seed(self):
+        database = self.components["database"]
+        password_hash = self.components["password_hasher"].hash(PASSWORD)
+        now = datetime.datetime.now().isoformat()
+
+        users = [{
+            "email": f"user{index}@benchmark.local",
+            "full_name": f"User {index}",
+            "username": f"user{index}",
+            "phone": "0000000000",
+            "password": password_hash
+        } for index in range(self.args.users)]
+        user_ids = database.database_connection("users").insert_many(users).inserted_ids
+        self.user_id = str(user_ids[0])
+        self.encoded_user_id = base64.urlsafe_b64encode(self.user_id.encode()).decode()
+
+        # Half the lamps are read and updated, the other half are consumed by delete_lamp
+        lamps = [{
+            "led": index,
+            "status": 1,
+            "intensity": random.randint(0, 100),
+            "colour": "#%06x" % random.randint(0, 0xFFFFFF),
+            "qr_id": "%032x" % random.getrandbits(128),
+            "created_by": self.user_id,
+            "updated_by": self.user_id,
+            "created_at": now,
+            "updated_at": now
+        } for index in range(self.args.lamps * 2)]
+        lamp_ids = database.database_connection("lamps").insert_many(lamps).inserted_ids
+        self.lamp_ids = [base64.urlsafe_b64encode(str(lamp_id).encode()).decode() for lamp_id in lamp_ids[:self.args.lamps]]
+        self.deletable_lamp_ids = [base64.urlsafe_b64encode(str(lamp_id).encode()).decode() for lamp_id in lamp_ids[self.args.lamps:]]
+        self.qr_ids = [lamp["qr_id"] for lamp in lamps[:self.args.lamps]]
+
+        deleted_datas = [{
+            "deleted_lamp_id": "%024x" % random.getrandbits(96),
+            "deleted_by": self.user_id
+        } for _ in range(self.args.deleted)]
+        if deleted_datas:
+            database.database_connection("deleted_datas").insert_many(deleted_datas)
+
+        tokens = self.components["auth"].issue_tokens(self.user_id)
+        self.headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {tokens['accessToken']}"
+        }
+        self.refresh_token = tokens["refreshToken"]
+
+        # One change through the API, so lamp_events_stream has an event to send right away
+        self.app.test_client().post(f"/api/create_lamp/{self.encoded_user_id}", json=self.lamp_payload(), headers=self.headers)
+
+        # A week of hourly readings for the first lamps, so energy reads populated rollups
+        from api.EnergyRollup import EnergyRollup
+        week_ago = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=7)
+        readings = [{
+            "ts": week_ago + datetime.timedelta(hours=hour),
+            "meta": { "user": self.user_id, "led": led },
+            "current_ma": random.randint(0, 500)
+        } for led in range(min(self.args.lamps, 10)) for hour in range(7 * 24)]
+        EnergyRollup(self.components["logging"], database).apply(readings)
+
+    def lamp_payload(self):
+        return {
+            # Above the seeded leds and below 65536, the binary device frame stores led as 16 bits
+            "led": self.args.lamps * 2 + self.next_number(),
+            "status": 1,
+            "intensity": 50,
+            "colour": "#ffaa00"
+        }
+
+    def telemetry_samples(self):
+        # One reading per second for the first lamps, as a board controller batches them
+        return [[second * 1000, led, random.randint(0, 500)] for second in range(10) for led in range(min(self.args.lamps, 10))]
+
+    def telemetry_frame(self):
+        samples = self.telemetry_samples()
+        frame = struct.pack(">3sBHQ", b"TLM", 1, len(samples), int(time.time() * 1000))
+        return frame + b"".join(struct.pack(">IHh", *sample) for sample in samples)
+
+    def scenarios(self):
+        # (name, method, path, body[, headers]) functions, requests without headers use the shared JSON ones
+        user = self.encoded_user_id
+
+        def refresh_payload():
+            # Refresh tokens are single use, so each request trades a fresh one
+            return { "refreshToken": self.components["auth"].issue_tokens(self.user_id)["refreshToken"] }
+
+        def logout_headers():
+            # Logout revokes the bearer token, so it must not be the shared one
+            return { **self.headers, "Authorization": f"Bearer {self.components['auth'].issue_tokens(self.user_id)['accessToken']}" }
+
+        def frame_headers():
+            return { **self.headers, "Content-Type": "application/octet-stream" }
+
+        def changes_since():
+            # A client that is a few writes behind
+            return max(self.components["database"].committed_version(self.user_id) - 20, 0)
+
+        return [
+            ("register_user", "POST", lambda: "/api/register_user", lambda: {
+                "email": f"new{self.next_number()}@benchmark.local",
+                "full_name": "New User",
+                "username": "new",
+                "phone": "0000000000",
+                "password": PASSWORD,
+                "confirm_password": PASSWORD
+            }),
+            ("authenticate_user", "POST", lambda: "/api/authenticate_user", lambda: {
+                "email": "user0@benchmark.local",
+                "password": PASSWORD
+            }),
+            ("refresh_token", "POST", lambda: "/api/refresh_token", refresh_payload),
+            ("create_lamp", "POST", lambda: f"/api/create_lamp/{user}", self.lamp_payload),
+            ("create_lamps", "POST", lambda: f"/api/create_lamps/{user}", lambda: {
+                "lamps": [self.lamp_payload() for _ in range(10)]
+            }),
+            ("retrieve_all_lamps", "GET", lambda: f"/api/retrieve_all_lamps/{user}", None),
+            ("retrieve_all_lamps_stream", "GET", lambda: f"/api/retrieve_all_lamps/{user}?stream=1", None),
+            ("retrieve_lamp", "GET", lambda: f"/api/retrieve_lamp/{user}/{random.choice(self.lamp_ids)}", None),
+            ("update_lamp", "PUT", lambda: f"/api/update_lamp/{user}/{random.choice(self.lamp_ids)}", lambda: {
+                "intensity": random.randint(0, 100)
+            }),
+            ("update_lamps", "PUT", lambda: f"/api/update_lamps/{user}", lambda: {
+                "lamps": [{ "lamp_id": lamp_id, "intensity": 40 } for lamp_id in random.sample(self.lamp_ids, min(10, len(self.lamp_ids)))]
+            }),
+            ("device_lamps", "GET", lambda: f"/api/device/lamps/{user}?format=bin", None),
+            ("lamp_events", "GET", lambda: f"/api/lamp_events/{user}?timeout=0", None),
+            ("lamp_changes", "GET", lambda: f"/api/lamp_changes/{user}?since={changes_since()}", None),
+            ("lamp_changes_full", "GET", lambda: f"/api/lamp_changes/{user}?since=0", None),
+            # lastEventId=0 is behind the seeded change, so the first event (or a resync) is sent without waiting
+            ("lamp_events_stream", "GET", lambda: f"/api/lamp_events/stream/{user}?lastEventId=0", None),
+            ("telemetry", "POST", lambda: f"/api/telemetry/{user}", lambda: {
+                "t0": int(time.time() * 1000),
+                "samples": self.telemetry_samples()
+            }),
+            ("telemetry_binary", "POST", lambda: f"/api/telemetry/{user}", self.telemetry_frame, frame_headers),
+            ("energy_hour", "GET", lambda: f"/api/energy/{user}?period=hour", None),
+            ("energy_month", "GET", lambda: f"/api/energy/{user}?period=month", None),
+            ("lamp_qr", "GET", lambda: f"/api/lamp_qr/{random.choice(self.qr_ids)}", None),
+            ("retrieve_all_deleted_datas", "GET", lambda: f"/api/retrieve_all_deleted_datas/{user}", None),
+            ("delete_lamp", "DELETE", lambda: f"/api/delete_lamp/{user}/{self.deletable_lamp_ids.pop()}", None),
+            ("logout", "POST", lambda: "/api/logout", refresh_payload, logout_headers)
+        ]
+
+    @staticmethod
+    def encode(body):
+        # Binary frames are sent as they are
+        if body is None or isinstance(body, bytes):
+            return body
+        return json.dumps(body)
+
+    def request(self, connection, method, path, body, headers):
+        started = time.perf_counter()
+        connection.request(method, path, body=self.encode(body), headers=headers)
+        response = connection.getresponse()
+        if response.getheader("Content-Type", "").startswith("text/event-stream"):
+            # The stream never ends, read up to the blank line closing the first event
+            while response.readline().strip():
+                pass
+            elapsed = time.perf_counter() - started
+            # http.client opens a new connection for the next request
+            connection.close()
+            return elapsed, response.status
+        response.read()
+        return time.perf_counter() - started, response.status
+
+    def run_scenario(self, name, method, path_function, body_function, headers_function=None):
+        requests = self.args.requests
+        if name == "delete_lamp":
+            requests = min(requests, len(self.deletable_lamp_ids))
+        local = threading.local()
+
+        def one_request(_):
+            # One keep-alive capable connection per client thread
+            if not hasattr(local, "connection"):
+                local.connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+            try:
+                return self.request(
+                    local.connection,
+                    method,
+                    path_function(),
+                    body_function() if body_function else None,
+                    headers_function() if headers_function else self.headers
+                )
+            except (http.client.HTTPException, OSError):
+                local.connection.close()
+                del local.connection
+                return None, 599
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+            results = list(executor.map(one_request, range(requests)))
+        elapsed = time.perf_counter() - started
+
+        latencies = sorted(latency for latency, _ in results if latency is not None)
+        errors = sum(1 for _, status in results if status >= 400)
+        return {
+            "requests": requests,
+            "errors": errors,
+            "throughput_rps": round(requests / elapsed, 2) if elapsed else None,
+            "latency_ms": {
+                "p50": self.percentile(latencies, 50),
+                "p95": self.percentile(latencies, 95),
+                "p99": self.percentile(latencies, 99),
+                "max": round(latencies[-1] * 1000, 3) if latencies else None
+            },
+            "peak_alloc_kib_median": self.measure_allocations(name, method, path_function, body_function, headers_function)
+        }
+
+    def measure_allocations(self, name, method, path_function, body_function, headers_function=None):
+        # In-process through the test client, so only server-side allocations are traced
+        # tracemalloc counts every thread, so log, write-behind and telemetry threads can add to one sample:
+        # warm-up requests (lazy imports, caches, tracemalloc itself) are not counted and the median is reported
+        if name == "delete_lamp" and not self.deletable_lamp_ids:
+            return None
+        client = self.app.test_client()
+        samples = []
+        tracemalloc.start()
+        try:
+            for index in range(self.args.alloc_warmup + self.args.alloc_samples):
+                if name == "delete_lamp" and not self.deletable_lamp_ids:
+                    break
+                path = path_function()
+                body = self.encode(body_function() if body_function else None)
+                headers = headers_function() if headers_function else self.headers
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+                response = client.open(path, method=method, data=body, headers=headers, buffered=False)
+                if response.mimetype == "text/event-stream":
+                    # Only the first event, like the HTTP run
+                    next(response.iter_encoded())
+                else:
+                    response.get_data()
+                response.close()
+                if index >= self.args.alloc_warmup:
+                    samples.append(tracemalloc.get_traced_memory()[1] - baseline)
+        finally:
+            tracemalloc.stop()
+        return round(statistics.median(samples) / 1024, 2) if samples else None
+
+    @staticmethod
+    def percentile(latencies, percent):
+        if not latencies:
+            return None
+        index = min(len(latencies) - 1, int(round(percent / 100 * (len(latencies) - 1))))
+        return round(latencies[index] * 1000, 3)
+
+    def run(self):
+        self.boot()
+        self.seed()
+
+        selected = set(self.args.routes.split(",")) if self.args.routes else None
+        results = {}
+        for name, *scenario in self.scenarios():
+            if selected and name not in selected:
+                continue
+            results[name] = self.run_scenario(name, *scenario)
+            self.print_result(name, results[name])
+
+        self.server.shutdown()
+        return {
+            "commit": self.git_commit(),
+            "timestamp": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "backend": "mongod" if self.args.mongo_uri else "mongomock",
+            # Logs and QR images written during the run
+            "work_path": self.work_path,
+            "config": {
+                "users": self.args.users,
+                "lamps": self.args.lamps,
+                "deleted": self.args.deleted,
+                "concurrency": self.args.concurrency,
+                "requests": self.args.requests,
+                "bcrypt_cost": self.components["password_hasher"].cost
+            },
+            "results": results
+        }
+
+    @staticmethod
+    def git_commit():
+        try:
+            return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_PATH, text=True).strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    @staticmethod
+    def print_result(name, result):
+        latency = result["latency_ms"]
+        print(
+            f"{name:<28} {result['throughput_rps']:>9} req/s  p50 {latency['p50']:>8} ms  p95 {latency['p95']:>8} ms  "
+            f"p99 {latency['p99']:>8} ms  alloc p50 {result['peak_alloc_kib_median']} KiB  errors {result['errors']}/{result['requests']}"
+        )
+
+def compare(current, previous_path):
+    with open(previous_path, "r") as file:
+        previous = json.load(file)
+
+    print(f"\nCompared with {previous.get('commit')} ({previous.get('timestamp')})")
+    for name, result in current["results"].items():
+        before = previous["results"].get(name)
+        if not before or not before["latency_ms"]["p95"] or not result["latency_ms"]["p95"]:
+            continue
+        throughput_change = (result["throughput_rps"] / before["throughput_rps"] - 1) * 100
+        p95_change = (result["latency_ms"]["p95"] / before["latency_ms"]["p95"] - 1) * 100
+        print(f"{name:<28} throughput {throughput_change:+7.1f}%  p95 {p95_change:+7.1f}%")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every API route of the smart lamp backend.")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--lamps", type=int, default=500)
+    parser.add_argument("--deleted", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=400, help="Requests per route.")
+    parser.add_argument("--alloc-samples", type=int, default=20, help="Sequential requests per route traced for allocations.")
+    parser.add_argument("--alloc-warmup", type=int, default=3, help="Requests per route sent before the allocation samples.")
+    parser.add_argument("--bcrypt-cost", type=int, default=12, help="Used unless BCRYPT_COST is already set.")
+    parser.add_argument("--routes", help="Comma separated route names, all routes by default.")
+    parser.add_argument("--mongo-uri", help="Use this mongod instead of mongomock. The benchmark database is dropped first.")
+    parser.add_argument("--db-name", default="lamp_benchmark")
+    parser.add_argument("--output", default=os.path.join(BACKEND_PATH, "benchmarks", "results"))
+    parser.add_argument("--compare", help="Earlier result file to compare against.")
+    args = parser.parse_args()
+
+    report = Benchmark(args).run()
+
+    os.makedirs(args.output, exist_ok=True)
+    result_file = os.path.join(
+        args.output,
+        f"{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}-{report['commit'] or 'nogit'}.json"
+    )
+    with open(result_file, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"\nSaved {result_file}")
+
+    if args.compare:
+        compare(report, args.compare)
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
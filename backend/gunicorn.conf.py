@@ -0,0 +1,60 @@
+import os
+import sys
+import signal
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from Config import Config
+
+# Loaded in the master too, so an invalid .env or paths.yaml fails before any worker forks
+server_config = Config.load().server
+
+# Pre-fork server settings, see the GUNICORN_* variables in .env.example
+bind = server_config.bind
+# One worker by default: device snapshots, lamp events, revoked tokens and /metrics live in process memory,
+# and each worker would rotate and compress the same log files. More workers need those shared first.
+# Scale with GUNICORN_THREADS meanwhile, Mongo and bcrypt calls release the GIL
+workers = server_config.workers
+# Threads per worker, long-poll and SSE requests each hold one
+# At most LAMP_MAX_WAITERS of them wait at once (503 with Retry-After beyond that), the rest stay free for
+# logins and writes. Sizing: every connected board or SSE client is one waiter, so set LAMP_MAX_WAITERS to the
+# number of boards per worker and GUNICORN_THREADS to that plus the threads normal traffic needs (4 or more)
+worker_class = "gthread"
+threads = server_config.threads
+# Each worker imports wsgi.py after the fork, no sockets or threads are shared
+preload_app = False
+# Longer than the 60 second long-poll limit in LampApi
+timeout = server_config.timeout
+graceful_timeout = server_config.graceful_timeout
+keepalive = server_config.keepalive
+# Recycle workers now and then, jitter keeps them from restarting together
+max_requests = server_config.max_requests
+max_requests_jitter = server_config.max_requests_jitter
+
+def on_starting(server):
+    if workers > 1:
+        server.log.warning(
+            f"GUNICORN_WORKERS={workers}: lamp events and device snapshots are not shared between workers, "
+            "logout only holds on the worker that served it, /metrics covers one worker and log rotation is not coordinated"
+        )
+
+def components(worker):
+    app = getattr(worker, "wsgi", None)
+    return app.extensions.get("smart_lamp") if app is not None else None
+
+def post_worker_init(worker):
+    # The app is built and warmed up at this point, requests are accepted after this hook
+    handle_exit = worker.handle_exit
+
+    def handle_term(signum, frame):
+        # Wake long-poll and SSE clients so in-flight requests end within graceful_timeout
+        smart_lamp = components(worker)
+        if smart_lamp is not None:
+            smart_lamp["events"].close()
+        handle_exit(signum, frame)
+
+    signal.signal(signal.SIGTERM, handle_term)
+
+def worker_exit(server, worker):
+    smart_lamp = components(worker)
+    if smart_lamp is not None:
+        smart_lamp["shutdown"]()
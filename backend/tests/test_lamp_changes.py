@@ -0,0 +1,103 @@
+import threading
+import mongomock
+import pytest
+from pymongo.errors import DuplicateKeyError
+from Config import DatabaseConfig
+from Database import Database
+
+class Logging:
+
+    def log_debug(self, message):
+        pass
+
+@pytest.fixture
+def database():
+    config = DatabaseConfig(
+        connection="mongodb", host="127.0.0.1", port=27017, name="lamp_test", username="", password="",
+        timeout_ms=2000, auth_source="admin", app_name="", max_pool_size=10, min_pool_size=0,
+        max_idle_time_ms=60000, wait_queue_timeout_ms=5000, user_cache_size=10, user_cache_ttl=60.0
+    )
+    return Database(Logging(), config, client=mongomock.MongoClient())
+
+OWNER = "owner"
+
+def sync(database, since, owner=OWNER):
+    # Same reads as /api/lamp_changes: the mark first, then the lamps above since
+    version = database.committed_version(owner)
+    lamps = database.database_connection("lamps")
+    changed = [lamp["led"] for lamp in lamps.find({ "created_by": owner, "version": { "$gt": since } }).sort("version", 1)]
+    return version, changed
+
+def test_slow_writer_is_not_skipped(database):
+    lamps = database.database_connection("lamps")
+    with database.next_version(OWNER) as version:
+        lamps.insert_one({ "led": 1, "created_by": OWNER, "version": version })
+    mark, changed = sync(database, 0)
+    assert (mark, changed) == (1, [1])
+
+    # The slow writer takes version 2 and stalls before its insert lands
+    taken = threading.Event()
+    release = threading.Event()
+    def slow_writer():
+        with database.next_version(OWNER) as version:
+            taken.set()
+            release.wait(5)
+            lamps.insert_one({ "led": 2, "created_by": OWNER, "version": version })
+    thread = threading.Thread(target=slow_writer)
+    thread.start()
+    taken.wait(5)
+
+    # A fast writer takes and writes version 3 meanwhile
+    with database.next_version(OWNER) as version:
+        lamps.insert_one({ "led": 3, "created_by": OWNER, "version": version })
+
+    # The sync sees led 3, but must not hand out a mark at or above the pending version 2
+    mark, changed = sync(database, mark)
+    assert changed == [3]
+    assert mark < 2
+
+    release.set()
+    thread.join()
+
+    # Once the slow write lands, the next sync from that mark picks it up
+    mark, changed = sync(database, mark)
+    assert 2 in changed
+    assert mark == 3
+    assert sync(database, mark) == (3, [])
+
+def test_other_owners_do_not_hold_back_the_mark(database):
+    lamps = database.database_connection("lamps")
+    with database.next_version("other"):
+        with database.next_version(OWNER) as version:
+            lamps.insert_one({ "led": 1, "created_by": OWNER, "version": version })
+        assert sync(database, 0) == (1, [1])
+
+def test_dead_writer_stops_holding_back_the_mark(database):
+    counters = database.database_connection("counters")
+    counters.insert_one({ "_id": database.version_counter(OWNER), "seq": 5, "floor": 4, "open": 1, "touched_at": 0 })
+    assert database.committed_version(OWNER) == 5
+    # Reset, so the next writer's release moves the mark again
+    with database.next_version(OWNER) as version:
+        assert version == 6
+    assert database.committed_version(OWNER) == 6
+
+def test_owner_counters_continue_the_global_counter(database):
+    database.database_connection("counters").insert_one({ "_id": "lamps", "seq": 40 })
+    assert database.committed_version(OWNER) == 40
+    with database.next_version(OWNER) as version:
+        assert version == 41
+
+def test_first_writes_racing_on_the_counter_upsert(database, monkeypatch):
+    original = mongomock.collection.Collection.find_one_and_update
+    def raced(collection, filter, update, **kwargs):
+        if kwargs.get("upsert"):
+            # The other first writer creates the counter between our find and insert
+            monkeypatch.setattr(mongomock.collection.Collection, "find_one_and_update", original)
+            original(collection, filter, update, **kwargs)
+            database.release_version(filter["_id"])
+            raise DuplicateKeyError("E11000 duplicate key error")
+        return original(collection, filter, update, **kwargs)
+    monkeypatch.setattr(mongomock.collection.Collection, "find_one_and_update", raced)
+    with database.next_version(OWNER) as version:
+        assert version == 2
+    assert database.committed_version(OWNER) == 2
@@ -0,0 +1,14 @@
+"""
+* Production entry point: gunicorn -c gunicorn.conf.py wsgi:app
+* gunicorn imports this module in each worker after the fork (preload_app is off),
+  so every worker builds its own MongoClient, log listener and thread pools
+* Runs one worker by default: lamp events, device snapshots, revoked tokens, metrics and log rotation
+  are per process, see gunicorn.conf.py before raising GUNICORN_WORKERS
+* Set JWT_SECRET, otherwise each worker signs tokens with its own random secret
+* kill -HUP <worker pid> reloads the hot-swappable settings in place (see ConfigReloader),
+  kill -HUP <master pid> makes gunicorn replace every worker
+"""
+
+from app import create_app
+
+app = create_app()
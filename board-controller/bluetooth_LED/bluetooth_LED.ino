@@ -1,6 +1,5 @@
 #include <WiFi.h>               // Include the WiFi library
 #include <HTTPClient.h>         // Include the HTTPClient library
-#include <ArduinoJson.h>        // Include the ArduinoJson library
 
 // LED 1
 #define LED1_RED 15   // GPIO 15
@@ -42,6 +41,12 @@ const char *password = "MY_WIFI_PASSWORD";
 
 // Const url for api call
 const char *baseApiPath = "http://127.0.0.1:500/api";
+// Long-lived device token from POST /api/device_token/<user id>, issuing a new one retires this one
+const char *deviceToken = "MY_DEVICE_TOKEN";
+
+// Last lamp event seen, the server holds the request until a newer one exists
+String lastEventId = "";
+const char *responseHeaders[] = {"X-Lamp-Event-Id", "Retry-After"};
 
 void setup() {
   // put your setup code here, to run once:
@@ -79,39 +84,92 @@ void loop() {
   if (WiFi.status() == WL_CONNECTED) {
     HTTPClient http;
 
-    String endpoint = "/retrieve_all_lamps/NjcxMzAwZGI5NDVhYjU1NjU0ZjQ4MGNj";
+    // Compact endpoint: one "led,status,intensity,red,green,blue" line per lamp
+    // wait=1 long-polls, the server answers as soon as a lamp changes (or 304 after the timeout)
+    String endpoint = "/device/lamps/NjcxMzAwZGI5NDVhYjU1NjU0ZjQ4MGNj?format=csv";
+    if (lastEventId.length() > 0) {
+      endpoint += "&wait=1&timeout=25&lastEventId=" + lastEventId;
+    }
     String apiCall = String(baseApiPath) + endpoint;
     http.begin(apiCall.c_str());
+    http.setTimeout(30000);
+    http.addHeader("Authorization", String("Bearer ") + deviceToken);
+    http.collectHeaders(responseHeaders, 2);
 
     // Send HTTP GET request
     int httpResponseCode = http.GET();
 
-    if (httpResponseCode > 0) {
+    if (httpResponseCode == 304) {
+      // Nothing changed before the timeout, poll again right away
+      http.end();
+      return;
+    }
+
+    if (httpResponseCode == 200) {
       String payload = http.getString(); // Get the response payload
+      lastEventId = http.header("X-Lamp-Event-Id");
       Serial.println("HTTP Response code: " + String(httpResponseCode));
-      Serial.println("Response payload: " + payload);
 
-      // Parse JSON
-      DynamicJsonDocument doc(1024); // Allocate memory for the JSON document
-      DeserializationError error = deserializeJson(doc, payload); // Parse JSON
-
-      // Check for errors
-      if (error) {
-        Serial.println("Failed to parse JSON: " + String(error.c_str()));
-        return;
+      // Apply each line, the payload size grows by a few bytes per lamp only
+      int lineStart = 0;
+      while (lineStart < payload.length()) {
+        int lineEnd = payload.indexOf('\n', lineStart);
+        if (lineEnd < 0) {
+          lineEnd = payload.length();
+        }
+        applyLampLine(payload.substring(lineStart, lineEnd));
+        lineStart = lineEnd + 1;
       }
-
-      // Access JSON fields
-      const char* value = doc["key"]; // Replace "key" with your JSON key
-      Serial.println("Value from JSON: " + String(value));
     } 
+    else if (httpResponseCode == 503) {
+      // Every waiter slot on the server is taken, back off as long as it asks
+      int retryAfter = http.header("Retry-After").toInt();
+      Serial.println("Server busy, retrying in " + String(retryAfter) + " s");
+      http.end();
+      delay((retryAfter > 0 ? retryAfter : 5) * 1000);
+      return;
+    }
     else {
       Serial.println("Error on HTTP request: " + String(httpResponseCode));
     }
     http.end(); // Close the connection
   }
 
-  delay(5000); // Delay of 5 seconds before repeating the loop
+  delay(1000); // Short back-off, the long-poll itself paces the loop
+}
+
+// Function to Parse One "led,status,intensity,red,green,blue" Line and Drive The LED
+void applyLampLine(String line) {
+  int values[6];
+  int fieldStart = 0;
+  for (int i = 0; i < 6; i++) {
+    if (fieldStart > (int) line.length()) {
+      Serial.println("Invalid lamp line: " + line);
+      return;
+    }
+    int fieldEnd = line.indexOf(',', fieldStart);
+    if (fieldEnd < 0) {
+      fieldEnd = line.length();
+    }
+    values[i] = line.substring(fieldStart, fieldEnd).toInt();
+    fieldStart = fieldEnd + 1;
+  }
+
+  int led = values[0];
+  int status = values[1];
+  // Intensity is a percentage, scale each colour channel by it
+  int intensity = status ? constrain(values[2], 0, 100) : 0;
+  int red = values[3] * intensity / 100;
+  int green = values[4] * intensity / 100;
+  int blue = values[5] * intensity / 100;
+
+  if (led == 1) {
+    pwmWrite(LED1_CHANNEL_RED, LED1_CHANNEL_GREEN, LED1_CHANNEL_BLUE, red, green, blue);
+  } else if (led == 2) {
+    pwmWrite(LED2_CHANNEL_RED, LED2_CHANNEL_GREEN, LED2_CHANNEL_BLUE, red, green, blue);
+  } else if (led == 3) {
+    pwmWrite(LED3_CHANNEL_RED, LED3_CHANNEL_GREEN, LED3_CHANNEL_BLUE, red, green, blue);
+  }
 }
 
 // Function for Connecting to Wi-Fi Network with SSID and Password
@@ -156,3 +214,10 @@ void pwmAttachPin(int red, int green, int blue, int rChannel, int gChannel, int
   ledcAttachPin(green, gChannel);
   ledcAttachPin(blue, bChannel);
 }
+
+// Function to Write Duty Cycle to Each Channel of One LED
+void pwmWrite(int rChannel, int gChannel, int bChannel, int red, int green, int blue) {
+  ledcWrite(rChannel, red);
+  ledcWrite(gChannel, green);
+  ledcWrite(bChannel, blue);
+}